@@ -1,14 +1,11 @@
 import copy
+import sys
 import typing
 from abc import ABC
-from itertools import chain
 from typing import Dict, Union, Set, Any, TYPE_CHECKING, List, Type
 
-import inflect
-import inflection
-from marshmallow.fields import Field as MarshmellowField
-
-from arorm.databases.abstract import Filter
+from arorm import indexes
+from arorm.databases.abstract import Expression, Filter
 
 if TYPE_CHECKING:
     from arorm.store import Store
@@ -25,6 +22,12 @@ class Symbol:
 Internal = Symbol('internal')
 
 
+def is_marshmallow_field(obj):
+    # marshmallow is only imported by code that declares marshmallow fields, so it is not imported here
+    fields = sys.modules.get('marshmallow.fields', None)
+    return fields is not None and isinstance(obj, fields.Field)
+
+
 class FieldMeta(type):
     def __new__(mcs, name, bases, attrs):
         super_new = super(FieldMeta, mcs).__new__
@@ -32,7 +35,7 @@ class FieldMeta(type):
         new_fields = {}
         new_attrs = {**attrs}
         for obj_name, obj in attrs.items():
-            if isinstance(obj, MarshmellowField):
+            if is_marshmallow_field(obj):
                 obj = Field()
             if 'Field' in globals() and isinstance(obj, Field):
                 # add to schema fields
@@ -82,6 +85,10 @@ class FieldMeta(type):
 
 class Filterable:
     _name: str
+    # set by ModelMeta for model attributes, so building filters does not walk the parents
+    _property_path: str = None
+
+    __hash__ = object.__hash__
 
     def __eq__(self, b):
         return Filter(name=self.get_property_path(), op='eq', var=b)
@@ -101,6 +108,18 @@ class Filterable:
     def __contains__(self, b):
         raise Exception ('does not make sense')
 
+    def __add__(self, b):
+        return Expression(name=self.get_property_path(), op='add', var=b)
+
+    def __sub__(self, b):
+        return Expression(name=self.get_property_path(), op='sub', var=b)
+
+    def __mul__(self, b):
+        return Expression(name=self.get_property_path(), op='mul', var=b)
+
+    def __truediv__(self, b):
+        return Expression(name=self.get_property_path(), op='div', var=b)
+
     @property
     def not_(self):
         def __in(x):
@@ -125,6 +144,8 @@ class Filterable:
         return Filter(name=self.get_property_path(), op='contains_', var=(b, is_in))
 
     def get_property_path(self):
+        if self._property_path is not None:
+            return self._property_path
         if hasattr(self, '_property_path_parent'):
             if hasattr (self._property_path_parent, 'get_property_path'):
                 return self._property_path_parent.get_property_path() + '.' + self._name
@@ -145,10 +166,11 @@ class Field(Filterable):
     def from_db(value):
         return value
 
-    def __init__(self, default=None, nullable=True, hidden=False):
+    def __init__(self, default=None, nullable=True, hidden=False, index=False):
         self.default = default
         self.nullable = nullable
         self.hidden = hidden
+        self.index = index
         self.ref_name = None
 
     def __get__(self, obj: 'Model', objtype=None) -> Any:
@@ -189,7 +211,7 @@ class RemoteReferenceList:
     def __get__(self, obj: 'Model', owner=None) -> Any:
         if not obj: return self.ref_field
         if self._name not in obj._ref_vals:
-            obj._ref_vals[self._name] = obj._store.query(self.model).filter(f'{self.ref_field}=="{obj.id}"').all()
+            obj._ref_vals[self._name] = obj._store.query(self.model).filter(Filter(self.ref_field, 'eq', obj.id)).all()
         return obj._ref_vals[self._name]
 
 
@@ -212,7 +234,7 @@ class RemoteReference:
         if not obj: return self.ref_field
         if self._name not in obj._ref_vals:
             ref_id = self.use_full_id and obj.full_id or obj.id
-            obj._ref_vals[self._name] = obj._store.query(self.model).filter(f'{self.ref_field}=="{ref_id}"').one()
+            obj._ref_vals[self._name] = obj._store.query(self.model).filter(Filter(self.ref_field, 'eq', ref_id)).one()
         return obj._ref_vals[self._name]
 
     def __set__(self, obj: 'Model', value: 'Model') -> None:
@@ -256,9 +278,17 @@ class Reference:
         return self._model
 
     def get_model_from_id(self, obj):
-        name = obj._data[self.ref_field._name].split("/")[0]
-        name = inflection.singularize(name)
-        name = ''.join([n.capitalize() for n in name.split('_')])
+        collection = obj._data[self.ref_field._name].split("/")[0]
+        model = ORM.models_by_collection.get(collection, None)
+        if model is not None:
+            return model
+        # collections shared by several models resolve by the singular of the collection name
+        name = ORM.model_names_by_collection.get(collection, None)
+        if name is None:
+            import inflection
+            name = inflection.singularize(collection)
+            name = ''.join([n.capitalize() for n in name.split('_')])
+            ORM.model_names_by_collection[collection] = name
         return ORM.all_models[name]
 
     def __get__(self, obj: 'Model', owner=None) -> Any:
@@ -289,7 +319,7 @@ class ReferenceIdList(Field):
     def __get__(self, obj: 'Model', objtype=None) -> Any:
         if not obj: return self
         if self.ref_name and self.ref_name in obj._ref_vals:
-            return [r.id for r in obj._ref_vals[self.ref_name]]
+            return obj._ref_vals[self.ref_name].ids()
         l = super(ReferenceIdList, self).__get__(obj, objtype)
         if not l:
             obj._data[self._name] = []
@@ -308,33 +338,57 @@ class ReferenceListImpl:
         self.collection = collection
         self.obj = obj
         self.ref_field = ref_field
-        self.added = []
+        # dicts are used as ordered sets, membership and removal do not need to load any member
+        self.added: Dict['Model', None] = {}
         self._refs = {}
-        self.__list = self.obj._data.get(self.ref_field._name, []) or []
+        self.__ids = dict.fromkeys(self.obj._data.get(self.ref_field._name, []) or [])
+
+    def _stored_id(self, obj: 'Model'):
+        if obj.id in self.__ids:
+            return obj.id
+        if obj._id in self.__ids:
+            return obj._id
+        return None
 
     def __contains__(self, item):
-        return item in self.all()
+        return item in self.added or (item.id is not None and self._stored_id(item) is not None)
+
+    def __len__(self):
+        return len(self.__ids) + len(self.added)
+
+    def ids(self):
+        return list(self.__ids) + [a.id for a in self.added]
+
+    def stored_ids(self):
+        """the ids already in the document, without the members appended since"""
+        return list(self.__ids)
 
     def __iter__(self):
-        self.iter = chain((self.obj._store.get(self.collection, x) for x in self.__list), self.added)
+        self.iter = iter(self.all())
         return self.iter
 
     def __next__(self):
         return next(self.iter)
 
     def all(self):
-        return [self.obj._store.get(self.collection, x) for x in self.__list] + self.added
+        # missing members are loaded with a single query
+        return self.obj._store.get_many(self.collection, list(self.__ids)) + list(self.added)
 
     def append(self, obj: 'Model'):
-        if obj not in self.added:
-            self.added.append(obj)
+        if obj in self:
+            return
+        self.added[obj] = None
         self.obj._dirty.add(self.ref_field._name)
 
     def remove(self, obj: 'Model'):
-        if obj.id:
-            self.__list.remove(obj.id)
+        if obj in self.added:
+            del self.added[obj]
         else:
-            self.added.remove(obj)
+            id = obj.id is not None and self._stored_id(obj)
+            if not id:
+                raise ValueError('not in list: ' + str(obj.full_id))
+            del self.__ids[id]
+        self.obj._dirty.add(self.ref_field._name)
 
 
 class ReferenceList:
@@ -447,7 +501,6 @@ class CollectionList(list):
             for f in [getattr(self.__model, ff) == value for ff in self.filter]:
                 f.or_ = True
                 q = q.filter(f)
-            print(q.make_aql())
         else:
             f: Filter = getattr(self.__model, self.filter) == value
             q = q.filter(f)
@@ -486,6 +539,8 @@ class Collection:
         return self._model
 
     def __get__(self, instance: 'Model', owner=None):
+        if instance is None:
+            return self
         if self._name not in instance._collection_vals:
             instance._collection_vals[self._name] = CollectionList(instance, self.model, self.ref_prop, self.own_prop, self.key_only)
             if self._name not in instance._collection_loaded:
@@ -532,7 +587,23 @@ class ModelPropertyAccessor(Filterable):
         self._fields = fields
         for f, v in fields.items():
             setattr(self, f, v)
-        
+
+    def _bind_path(self, path):
+        # property classes can be used by several models, so the accessor of a model gets
+        # its own copies of the fields with their full path
+        self._property_path = path
+        for name, f in self._fields.items():
+            if isinstance(f, Field):
+                f = copy.copy(f)
+                f._property_path = path + '.' + name
+            elif isinstance(f, ModelProperty) and not isinstance(f, list):
+                accessor = ModelPropertyAccessor(f._fields)
+                accessor._name = name
+                accessor.kwargs = f.kwargs
+                accessor.__impl__ = f.__class__
+                accessor._bind_path(path + '.' + name)
+                f = accessor
+            setattr(self, name, f)
 
     __impl__ = None
 
@@ -582,11 +653,12 @@ class ModelProperty(metaclass=FieldMeta):
 
     def __init__(self, data=None, parent=None, name=None, store=None, **kwargs):
         super().__init__()
-        for f, v in self._fields.items():
-            v._property_path_parent = self
         self.hidden = kwargs.get('hidden', False)
         self.nullable = kwargs.get('nullable', True)
         if parent is None and data is None:
+            # only declarations set the parent, instances created at runtime must not change the class fields
+            for f, v in self._fields.items():
+                v._property_path_parent = self
             self.kwargs = kwargs
             return
         self._name = name
@@ -802,6 +874,10 @@ class GraphRelationship:
 
 class ORM:
     all_models: Dict[str, 'Model'] = {}
+    # the model of each collection, None for collections shared by several models
+    models_by_collection: Dict[str, typing.Optional['Model']] = {}
+    # model names derived from collection names, used to resolve polymorphic references to shared collections
+    model_names_by_collection: Dict[str, str] = {}
 
     @staticmethod
     def model(model) -> 'Model':
@@ -819,7 +895,7 @@ class ModelMeta(type):
         refs = {}
 
         for obj_name, obj in attrs.items():
-            if isinstance(obj, MarshmellowField):
+            if is_marshmallow_field(obj):
                 obj = Field()
             if isinstance(obj, Field):
                 # add to schema fields
@@ -831,6 +907,9 @@ class ModelMeta(type):
                 new_attrs[obj_name]._name = obj_name
                 new_attrs[obj_name].kwargs = obj.kwargs
                 new_attrs[obj_name].__impl__ = obj.__class__
+                new_attrs[obj_name]._bind_path(obj_name)
+            elif isinstance(obj, Field):
+                obj._property_path = obj_name
             elif isinstance(obj, Reference):
                 refs[obj_name] = obj
             elif isinstance(obj, ReferenceList):
@@ -842,26 +921,42 @@ class ModelMeta(type):
         )
         new_class._refs = refs
         if not attrs.get('__collection__'):
+            import inflection
             new_class.__collection__ = inflection.pluralize(inflection.underscore(name))
         else:
             new_class.__collection__ = attrs.get('__collection__')
 
         for obj_name, obj in attrs.items():
-            if isinstance(obj, (Field, Reference, ReferenceList, MarshmellowField, Collection, RemoteReference, ModelProperty)):
+            if isinstance(obj, (Field, Reference, ReferenceList, Collection, RemoteReference, RemoteReferenceList, ModelProperty)) or is_marshmallow_field(obj):
                 obj._name = obj_name
 
         for obj_name, obj in attrs.items():
             if isinstance(obj, (Reference, ReferenceList)):
                 obj.ref_field.ref_name = obj._name
 
+        # used by Store.add_batch, identity conversions are skipped
+        new_class._from_db_converters = [
+            (key, getattr(type(f), 'from_db') is not Field.from_db and f.from_db or None, f.default or None)
+            for key, f in new_class._fields.items() if hasattr(f, 'from_db')
+        ]
+        new_class._reference_id_fields = [key for key, f in new_class._fields.items() if isinstance(f, ReferenceId)]
+
         if '_embedded' in attrs and attrs['_embedded']:
+            new_class._indexes = []
             return new_class
 
         ORM.all_models[name] = new_class
+        registered = ORM.models_by_collection.get(new_class.__collection__, new_class)
+        if registered is None or registered.__name__ != name:
+            ORM.models_by_collection[new_class.__collection__] = None
+        else:
+            ORM.models_by_collection[new_class.__collection__] = new_class
 
         for f,v in new_class._fields.items():
              setattr(v, '_property_path_parent', new_class)
 
+        new_class._indexes = indexes.collect(new_class)
+
         return new_class
 
 
@@ -915,7 +1010,24 @@ class ObjectView(object):
         return self.data
 
 
+class DirtySet(set):
+    """the dirty paths of an entity, tells its store when the entity becomes dirty"""
+    __slots__ = ('entity',)
+
+    def __init__(self, entity=None):
+        super().__init__()
+        self.entity = entity
+
+    def add(self, path):
+        was_clean = not self
+        set.add(self, path)
+        if was_clean and self.entity is not None and self.entity._store is not None:
+            self.entity._store._entity_dirtied(self.entity)
+
+
 class Model(metaclass=ModelMeta):
+    # set explicitly so that inflection is only imported by models without a __collection__
+    __collection__ = 'models'
     _id = Field()
     _key = Field()
     _rev = Field()
@@ -923,6 +1035,9 @@ class Model(metaclass=ModelMeta):
     _ref_vals: Dict[str, 'Model']
     _properties: Dict[str, Any]
     _collection_vals: Dict[str, CollectionList]
+    _indexes: List['indexes.Index']
+    _from_db_converters: List[typing.Tuple[str, Any, Any]]
+    _reference_id_fields: List[str]
     _store: 'Store'
     _embedded: bool = False
 
@@ -938,7 +1053,7 @@ class Model(metaclass=ModelMeta):
             data = {}
         self._name = name
         self.parent = parent
-        self._dirty = set()
+        self._dirty = DirtySet(self)
         self._store = store
         self._ref_vals = {}
         self._properties = {}
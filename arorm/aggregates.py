@@ -0,0 +1,31 @@
+from arorm.databases.abstract import Aggregate
+
+
+def _path(field):
+    if isinstance(field, str):
+        return field
+    return field.get_property_path()
+
+
+def count():
+    return Aggregate('count')
+
+
+def count_distinct(field):
+    return Aggregate('count_distinct', _path(field))
+
+
+def sum(field):
+    return Aggregate('sum', _path(field))
+
+
+def min(field):
+    return Aggregate('min', _path(field))
+
+
+def max(field):
+    return Aggregate('max', _path(field))
+
+
+def avg(field):
+    return Aggregate('avg', _path(field))
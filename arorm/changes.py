@@ -0,0 +1,53 @@
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm import Model
+
+
+class ChangeSet:
+    """
+    what one commit persisted, grouped by collection.
+    updated holds (entity, changed paths) pairs, operations the queued query actions ('update', 'delete', 'execute').
+    """
+
+    def __init__(self):
+        self.inserted: Dict[str, List['Model']] = {}
+        self.updated: Dict[str, List[Tuple['Model', Set[str]]]] = {}
+        self.removed: Dict[str, List['Model']] = {}
+        self.operations: Dict[str, List[str]] = {}
+
+    @property
+    def collections(self) -> Set[str]:
+        return set(self.inserted) | set(self.updated) | set(self.removed) | set(self.operations)
+
+    def only(self, collections: Optional[Set[str]]) -> 'ChangeSet':
+        """the changes of the given collections, or everything for None"""
+        if collections is None:
+            return self
+        result = ChangeSet()
+        for name in ('inserted', 'updated', 'removed', 'operations'):
+            setattr(result, name, {k: v for k, v in getattr(self, name).items() if k in collections})
+        return result
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.removed or self.operations)
+
+    def __repr__(self):
+        counts = ', '.join(f'{name}={sum(len(v) for v in getattr(self, name).values())}'
+                           for name in ('inserted', 'updated', 'removed', 'operations'))
+        return f'ChangeSet({counts})'
+
+
+def build(new, changes, removed, ops) -> ChangeSet:
+    """new and removed are entities, changes (entity, dirty paths) pairs and ops the queued (query, action, collections)"""
+    change_set = ChangeSet()
+    for e in new:
+        change_set.inserted.setdefault(e.__collection__, []).append(e)
+    for e, paths in changes:
+        change_set.updated.setdefault(e.__collection__, []).append((e, paths))
+    for e in removed:
+        change_set.removed.setdefault(e.__collection__, []).append(e)
+    for op in ops:
+        for collection in op[2]:
+            change_set.operations.setdefault(collection, []).append(op[1])
+    return change_set
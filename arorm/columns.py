@@ -0,0 +1,70 @@
+import array
+import itertools
+import re
+from collections import namedtuple
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm.databases.abstract import StoreQuery
+
+
+def _columns(fields, named_fields):
+    columns = [(re.sub(r'\W', '_', f if isinstance(f, str) else f.get_property_path()), f) for f in fields]
+    columns += list(named_fields.items())
+    return [(name, f if isinstance(f, str) else f.get_property_path(), f) for name, f in columns]
+
+
+class Column:
+    """the buffer of one column, an array for typecodes and a list otherwise"""
+
+    def __init__(self, name, field, typecode: Optional[str]):
+        from arorm import Number
+        if typecode is None and isinstance(field, Number):
+            typecode = 'd'
+        self.name = name
+        self.typecode = typecode
+        self.values = array.array(typecode) if typecode else []
+        default = getattr(field, 'default', None)
+        self.default = default() if callable(default) else default
+        if self.default is None and typecode in ('f', 'd'):
+            self.default = float('nan')
+
+    def extend(self, values: tuple):
+        if None in values:
+            if self.default is None and self.typecode:
+                raise Exception('column {} has null values, which an array of {} cannot hold'.format(
+                    self.name, self.typecode))
+            values = [self.default if v is None else v for v in values]
+        self.values.extend(values)
+
+    def to_numpy(self, np):
+        if self.typecode:
+            return np.frombuffer(self.values, dtype=self.typecode)
+        return np.array(self.values, dtype=object)
+
+
+def collect(query: 'StoreQuery', fields, named_fields, typecodes: Dict[str, str] = None, numpy=False,
+            batch_size=None) -> tuple:
+    """
+    reads the query into columns, rows stream in as lists and are transposed batch by batch.
+    columns of Number fields and those given a typecode are arrays, null values become the field default or nan.
+    """
+    if numpy:
+        try:
+            import numpy as np
+        except ImportError:
+            raise Exception('to_columns(numpy=True) needs numpy installed')
+    columns = _columns(fields, named_fields)
+    typecodes = typecodes or {}
+    buffers: List[Column] = [Column(name, f, typecodes.get(name, None)) for name, path, f in columns]
+    rows = iter(query._column_rows([path for name, path, f in columns], batch_size))
+    while True:
+        batch = list(itertools.islice(rows, batch_size or 1000))
+        if not batch:
+            break
+        for column, values in zip(buffers, zip(*batch)):
+            column.extend(values)
+    Columns = namedtuple(query.entity_type.__name__ + 'Columns', [name for name, path, f in columns], rename=True)
+    if numpy:
+        return Columns(*(c.to_numpy(np) for c in buffers))
+    return Columns(*(c.values for c in buffers))
@@ -1,11 +1,29 @@
+import importlib
 from typing import Dict, Type
 from arorm.databases.abstract import AbstractDatabase, DatabaseFactory
-from arorm.databases.arango import ArangoDatabaseFactory
 
-databases: Dict[str, Type[DatabaseFactory]] = {
-    'arango': ArangoDatabaseFactory
+# built-in drivers are imported on first use, so processes that only use models
+# do not load the arango client
+lazy_databases = {
+    'arango': ('arorm.databases.arango', 'ArangoDatabaseFactory'),
+    'memory': ('arorm.databases.memory', 'MemoryDatabaseFactory'),
 }
 
 
+class Databases(dict):
+    def __missing__(self, name):
+        if name not in lazy_databases:
+            raise KeyError(name)
+        module, factory = lazy_databases[name]
+        self[name] = getattr(importlib.import_module(module), factory)
+        return self[name]
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in lazy_databases
+
+
+databases: Dict[str, Type[DatabaseFactory]] = Databases()
+
+
 def register(name, db):
     databases[name] = db
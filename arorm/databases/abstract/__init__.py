@@ -1,12 +1,90 @@
+import base64
+import json
+import re
 import typing
 from typing import Type
 
+from arorm import columns, prefetch, records
+
 
 class AbstractDatabase:
-    def commit(self, new, changes, removed, query_ops: typing.List[typing.Tuple['ArangoStoreQuery', str]]):
+    def _find_deps(self, items, entity: 'Model', collected: set):
+        insertions = set()
+        from arorm import ReferenceListImpl
+        if entity not in items: return insertions
+        if entity not in collected:
+            insertions.add(entity)
+            collected.add(entity)
+        else:
+            return insertions
+        if isinstance(entity, ReferenceListImpl):
+            all = entity.all()
+            for a in all:
+                if a in items:
+                    insertions |= (self._find_deps(items, getattr(entity, a), collected))
+            return insertions
+        else:
+            for name in entity._refs.keys():
+                if getattr(entity, name):
+                    insertions |= (self._find_deps(items, getattr(entity, name), collected))
+        return insertions
+
+    @staticmethod
+    def _entity_undo(entity):
+        """restores the meta fields and the dirty state a commit sets on entity"""
+        data = entity._data.data
+        meta = {k: data.get(k, None) for k in ('_id', '_key', '_rev')}
+        dirty = set(entity._dirty)
+
+        def restore():
+            for k, v in meta.items():
+                if v is None:
+                    data.pop(k, None)
+                else:
+                    data[k] = v
+            entity._dirty.clear()
+            entity._dirty.update(dirty)
+        return restore
+
+    @staticmethod
+    def _is_ready(value, collected: set):
+        from arorm import Model, ReferenceListImpl
+        if isinstance(value, ReferenceListImpl):
+            return all(a in collected or a._id for a in value.added)
+        if isinstance(value, Model):
+            return value in collected or value._id
+        # prefetched remote relations (lists or None) are not dependencies of the owner
+        return True
+
+    def _compute_batch_order(self, items, collected: set):
+        from arorm import ReferenceListImpl
+        insertions = set(items)
+        batches = []
+        b = set()
+        while len(insertions):
+            for i in insertions:
+                if isinstance(i, ReferenceListImpl):
+                    insertions = insertions - i
+                    continue
+                if all(self._is_ready(r, collected) for r in i._ref_vals.values()):
+                    b.add(i)
+            if not len(b):
+                i = insertions.pop()
+                raise Exception('unable to commit, possible loop -> ' + str(i.to_json()))
+            insertions = insertions - b
+            collected.update(b)
+            batches.append(list(b))
+            b = set()
+        batches.append(b)
+        return batches
+
+    def commit(self, new, changes, removed, query_ops: typing.List[typing.Tuple['ArangoStoreQuery', str]], single_round_trip=False):
         pass
 
-    def setup_db(self,  models, graphs=[]):
+    def setup_db(self,  models, graphs=[]) -> typing.Dict[str, 'IndexReport']:
+        pass
+
+    def bulk_import(self, collection: str, docs: typing.List[dict], on_duplicate='error'):
         pass
 
 
@@ -22,10 +100,24 @@ class DatabaseFactory:
 T = typing.TypeVar('T')
 
 
+# cursor options accepted by StoreQuery.options, RawQuery.options and Store.set_query_options
+QUERY_OPTIONS = ('batch_size', 'ttl', 'stream', 'cache', 'full_count', 'memory_limit', 'max_runtime')
+
+
+def check_options(options: dict) -> dict:
+    for key in options:
+        if key not in QUERY_OPTIONS:
+            raise Exception('unknown query option: ' + key)
+    return options
+
+
 class RawQuery:
     query: str
     kwargs: dict
 
+    def options(self, **options) -> 'RawQuery':
+        pass
+
     def execute(self):
         pass
 
@@ -43,15 +135,44 @@ class RawQuery:
 
 
 class StoreQuery(typing.Generic[T]):
+    """the driver independent part of a query, drivers implement fetching the rows and compiling the filters"""
+    # copies the rows of the driver before they are hydrated, for drivers that hand out their stored documents
+    _copy = None
+
     def __init__(self, store: 'Store', entity_type: T):
-        super(StoreQuery, self).__init__(entity_type, store.database)
         self.store = store
         self.entity_type = entity_type
+        self._group_by = []
+        self._update_values = {}
+        self._updated_rows = []
+        self._readonly = False
+        # relations loaded for all results with one query each, see prefetch_related
+        self._prefetch = []
 
     def find_one(self, id) -> T:
         pass
 
     def get(self, id) -> T:
+        return self.store.get(self.entity_type, id)
+
+    def find_many(self, keys: typing.List[str]) -> typing.List[T]:
+        pass
+
+    def readonly(self) -> 'StoreQuery':
+        self._readonly = True
+        return self
+
+    def prefetch_related(self, *relations) -> 'StoreQuery[T]':
+        self._prefetch += [prefetch.relation(self.entity_type, r) for r in relations]
+        return self
+
+    def options(self, **options) -> 'StoreQuery':
+        pass
+
+    def fetch_many(self, keys: typing.List[str]) -> typing.List[dict]:
+        pass
+
+    def revisions(self, keys: typing.List[str]) -> typing.Dict[str, str]:
         pass
 
     def make_aql(self) -> str:
@@ -60,6 +181,26 @@ class StoreQuery(typing.Generic[T]):
     def all(self) -> typing.List[T]:
         pass
 
+    def _fetch(self) -> typing.List[dict]:
+        pass
+
+    def _hydrate(self, rows: typing.Iterable[dict]) -> typing.List[T]:
+        if self._readonly:
+            return records.load(self.entity_type, rows if self._copy is None else map(self._copy, rows))
+        entities = self.store.add_batch(self.entity_type, rows, self._copy)
+        if self._prefetch and entities:
+            prefetch.prefetch(self.store, entities, self._prefetch)
+        return entities
+
+    def iter_raw(self, batch_size=None, fields=None) -> typing.Iterator[dict]:
+        pass
+
+    def _column_rows(self, paths: typing.List[str], batch_size=None) -> typing.Iterator[list]:
+        pass
+
+    def to_columns(self, *fields, typecodes=None, numpy=False, batch_size=None, **named_fields) -> typing.NamedTuple:
+        return columns.collect(self, fields, named_fields, typecodes=typecodes, numpy=numpy, batch_size=batch_size)
+
     def one(self) -> T:
         pass
 
@@ -73,6 +214,77 @@ class StoreQuery(typing.Generic[T]):
     def filter(self, *args, **kwargs) -> 'StoreQuery[T]':
         pass
 
+    def delete(self) -> 'StoreQuery[T]':
+        self.store._queue_op(self, 'delete', [self.entity_type.__collection__])
+        return self
+
+    def update(self, values=None, **kwargs) -> 'StoreQuery[T]':
+        from arorm import Field, Number
+        values = dict(values or {}, **kwargs)
+        for key, value in values.items():
+            path = key if isinstance(key, str) else key.get_property_path()
+            field = self.entity_type._fields.get(path, None)
+            # expressions are computed by the database, where only the conversion of numbers can be matched
+            if isinstance(value, Expression) and field is not None and not isinstance(field, Number) \
+                    and getattr(type(field), 'to_db', Field.to_db) is not Field.to_db:
+                raise Exception('cannot update {} with an expression, its values are converted'.format(path))
+            self._update_values[path] = value
+        self.store._queue_op(self, 'update', [self.entity_type.__collection__])
+        return self
+
+    def sort(self, col_name, desc=False) -> 'StoreQuery[T]':
+        pass
+
+    def limit(self, num_records, start_from=0) -> 'StoreQuery[T]':
+        pass
+
+    def paginate(self, after=None, limit=100) -> typing.Tuple[typing.List[T], typing.Optional[str]]:
+        pass
+
+    def _page_keys(self) -> typing.List[typing.Tuple[str, bool]]:
+        """the (path, desc) sort keys of a page, _key is added as last sort key so that the order is total"""
+        keys = []
+        for sc in self._sort_columns:
+            parts = sc.split()
+            keys.append((parts[0], len(parts) > 1 and parts[1].upper() == 'DESC'))
+        if '_key' not in (path for path, desc in keys):
+            keys.append(('_key', keys[-1][1] if keys else False))
+            self.sort('_key' + (keys[-1][1] and ' DESC' or ''))
+        return keys
+
+    def _page(self, rows: typing.List[dict], keys, limit) -> typing.Tuple[typing.List[T], typing.Optional[str]]:
+        """hydrates the first limit of the sorted rows, with a token for the next page if there are more"""
+        token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            values = []
+            for path, desc in keys:
+                v = rows[-1]
+                for p in path.split('.'):
+                    v = v.get(p, None) if isinstance(v, dict) else None
+                values.append(v)
+            token = encode_page_token(values)
+        return self._hydrate(rows), token
+
+    def group_by(self, *fields, **named_fields) -> 'StoreQuery[T]':
+        for f in fields:
+            path = f if isinstance(f, str) else f.get_property_path()
+            self._group_by.append((re.sub(r'\W', '_', path), path))
+        for name, f in named_fields.items():
+            self._group_by.append((name, f if isinstance(f, str) else f.get_property_path()))
+        return self
+
+    def aggregate(self, **aggregates) -> typing.List[typing.NamedTuple]:
+        pass
+
+
+def encode_page_token(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+
 
 class Filter:
     def __init__(self, name, op, var):
@@ -84,3 +296,25 @@ class Filter:
         self.name = name
         self.var = var
         self.op = op
+
+    def __and__(self, other: 'Filter') -> 'Filter':
+        return Filter(None, 'and_', (self.op == 'and_' and self.var or [self]) + (other.op == 'and_' and other.var or [other]))
+
+    def __or__(self, other: 'Filter') -> 'Filter':
+        return Filter(None, 'or_', (self.op == 'or_' and self.var or [self]) + (other.op == 'or_' and other.var or [other]))
+
+    def __invert__(self) -> 'Filter':
+        return Filter(None, 'not_', self)
+
+
+class Expression:
+    def __init__(self, name, op, var):
+        self.name = name
+        self.op = op
+        self.var = var
+
+
+class Aggregate:
+    def __init__(self, op, name=None):
+        self.op = op
+        self.name = name
@@ -1,8 +1,14 @@
+import json
+import time
+import uuid
+from itertools import chain
 from typing import List, Tuple
 
 from arango import ArangoClient, exceptions
 from arango_orm.database import Database
 
+from arorm import instrumentation
+from arorm.indexes import IndexReport
 from arorm.databases.abstract import DatabaseFactory, AbstractDatabase, RawQuery
 from arorm.databases.arango.filter import ArangoFilter
 from arorm.databases.arango.query import ArangoStoreQuery
@@ -21,154 +27,215 @@ class ArangoDatabaseFactory(DatabaseFactory):
 
 class ArangoDatabase(Database, AbstractDatabase):
 
-    def _find_deps(self, items, entity: 'Model', collected: set):
-        insertions = set()
-        from core.orm import ReferenceListImpl
-        if entity not in items: return insertions
-        if entity not in collected:
-            insertions.add(entity)
-            collected.add(entity)
-        else:
-            return insertions
-        if isinstance(entity, ReferenceListImpl):
-            all = entity.all()
-            for a in all:
-                if a in items:
-                    insertions |= (self._find_deps(items, getattr(entity, a), collected))
-            return insertions
-        else:
-            for name in entity._refs.keys():
-                if getattr(entity, name):
-                    insertions |= (self._find_deps(items, getattr(entity, name), collected))
-        return insertions
-
-    def _compute_batch_order(self, items, collected: set):
-        insertions = set(items)
-        batches = []
-        b = set()
-        while len(insertions):
-            for i in insertions:
-                from core.orm import ReferenceListImpl
-                if isinstance(i, ReferenceListImpl):
-                    insertions = insertions - i
-                    continue
-                if all((r in collected or isinstance(r, ReferenceListImpl) or r._id for r in i._ref_vals.values())):
-                    b.add(i)
-            if not len(b):
-                i = insertions.pop()
-                raise Exception('unable to commit, possible loop -> ' + str(i.to_json()))
-            insertions = insertions - b
-            collected.update(b)
-            batches.append(list(b))
-            b = set()
-        batches.append(b)
-        return batches
-
-    def commit(self, new, changes, removed, query_ops: List[Tuple['ArangoStoreQuery', str]]):
-        collected = set()
-        insertions = self._compute_batch_order(new, collected)
-        changes = self._compute_batch_order(changes, collected)
-        collections = set((e.__collection__ for b in insertions for e in b))
-        collections = collections | (set((e.__collection__ for b in changes for e in b)))
-        collections = collections | (set((e.__collection__ for e in removed)))
-        collections = collections | set(coll for ops in query_ops for coll in ops[2])
-        tx = self.begin_transaction(write=list(collections))
-
-        for op in query_ops:
-            if op[1] == 'delete':
-                aql = op[0]._make_aql()
-                aql += "\n REMOVE {_key: rec._key} IN @@collection"
-                tx.aql.execute(aql, bind_vars=op[0]._bind_vars)
-                query_ops.remove(op)
-
-        for n in removed:
-            tx.delete_document(n._id)
+    def _execute(self, tx, aql, **kwargs):
+        if not instrumentation.instruments:
+            return tx.aql.execute(aql, **kwargs)
+        start = time.perf_counter()
+        result = list(tx.aql.execute(aql, **kwargs))
+        bytes_sent = len(aql) + len(json.dumps(kwargs.get('bind_vars', None), default=str))
+        instrumentation.emit('statement', aql, time.perf_counter() - start, bytes_sent, len(result))
+        return result
 
-        for batch in insertions:
-            collection_dict = {}
-            for b in batch:
-                if b._rev:
-                    print(b._id, b._rev, b._dump())
-                    raise Exception('cannot be new')
-                collection_dict[b.__collection__] = collection_dict.get(b.__collection__, [])
-                collection_dict[b.__collection__].append(b)
-            if not len(collection_dict.keys()):
-                continue
-            full_aql = ''
-            order = []
-            for collection, items in collection_dict.items():
-                order.extend(items)
-                aql = f"""
-                 let {collection}_result = (FOR doc in @docs.{collection}
-                   INSERT doc INTO {collection}
-                   LET inserted = NEW
-                   RETURN {{ _id: inserted._id, _key: inserted._key, _rev: inserted._rev }}
-                )
-                """
-                full_aql += aql
-            for collection in collection_dict.keys():
-                collection_dict[collection] = [x._dump() for x in collection_dict[collection]]
-
-            if len(collection_dict.keys()) > 1:
-                aql_return = 'UNION({0})'.format(','.join([k + '_result' for k in collection_dict.keys()]))
-            else:
-                aql_return = list(collection_dict.keys())[0] + '_result'
-            full_aql += 'FOR r in ' + aql_return + ' RETURN r'
+    def _insert_statement(self, batch):
+        collection_dict = {}
+        for b in batch:
+            if b._rev:
+                raise Exception('cannot be new')
+            collection_dict[b.__collection__] = collection_dict.get(b.__collection__, [])
+            collection_dict[b.__collection__].append(b)
+        full_aql = ''
+        order = []
+        for collection, items in collection_dict.items():
+            order.extend(items)
+            aql = f"""
+             let {collection}_result = (FOR doc in @docs.{collection}
+               INSERT UNSET(doc, '_id') INTO {collection}
+               LET inserted = NEW
+               RETURN {{ _id: inserted._id, _key: inserted._key, _rev: inserted._rev }}
+            )
+            """
+            full_aql += aql
+        timed = bool(instrumentation.instruments)
+        if timed:
+            start = time.perf_counter()
+        for collection in collection_dict.keys():
+            collection_dict[collection] = [x._dump() for x in collection_dict[collection]]
+        if timed:
+            instrumentation.emit('commit_phase', 'dump', time.perf_counter() - start)
 
-            print('full_aql', full_aql)
-            try:
-                pass
+        if len(collection_dict.keys()) > 1:
+            aql_return = 'UNION({0})'.format(','.join([k + '_result' for k in collection_dict.keys()]))
+        else:
+            aql_return = list(collection_dict.keys())[0] + '_result'
+        full_aql += 'FOR r in ' + aql_return + ' RETURN r'
 
-                #print('json len', json.dumps(collection_dict))
-            except Exception:
-                pass
-            result = tx.aql.execute(full_aql, bind_vars={'docs': collection_dict})
+        def on_result(result):
             for i, r in enumerate(result):
                 order[i].update(r)
                 order[i]._dirty.clear()
-        for batch in changes:
-            collection_dict = {}
-            for b in batch:
-                collection_dict[b.__collection__] = collection_dict.get(b.__collection__, [])
-                collection_dict[b.__collection__].append(b)
-            if not len(collection_dict.keys()):
-                continue
-            full_aql = ''
-            order = []
-            for collection, items in collection_dict.items():
-                order.extend(items)
-                aql = f"""
-                 let {collection}_result = (FOR doc in @docs.{collection}
-                   UPDATE doc IN {collection}
-                   LET inserted = NEW
-                   RETURN {{ _id: inserted._id, _key: inserted._key, _rev: inserted._rev }}
-                )
-                """
-                full_aql += aql
-            for collection in collection_dict.keys():
-                collection_dict[collection] = [x._dump(changes_only=True) for x in collection_dict[collection]]
-
-            if len(collection_dict.keys()) > 1:
-                aql_return = 'UNION({0})'.format(','.join([k + '_result' for k in collection_dict.keys()]))
-            else:
-                aql_return = list(collection_dict.keys())[0] + '_result'
-            full_aql += 'FOR r in ' + aql_return + ' RETURN r'
+        return full_aql, {'bind_vars': {'docs': collection_dict}}, on_result
+
+    def _update_statement(self, batch):
+        collection_dict = {}
+        for b in batch:
+            collection_dict[b.__collection__] = collection_dict.get(b.__collection__, [])
+            collection_dict[b.__collection__].append(b)
+        full_aql = ''
+        order = []
+        for collection, items in collection_dict.items():
+            order.extend(items)
+            aql = f"""
+             let {collection}_result = (FOR doc in @docs.{collection}
+               UPDATE doc IN {collection}
+               LET inserted = NEW
+               RETURN {{ _id: inserted._id, _key: inserted._key, _rev: inserted._rev }}
+            )
+            """
+            full_aql += aql
+        timed = bool(instrumentation.instruments)
+        if timed:
+            start = time.perf_counter()
+        for collection in collection_dict.keys():
+            collection_dict[collection] = [x._dump(changes_only=True) for x in collection_dict[collection]]
+        if timed:
+            instrumentation.emit('commit_phase', 'dump', time.perf_counter() - start)
 
-            print('full_aql', full_aql)
-            #print('json len', json.dumps(collection_dict))
-            result = tx.aql.execute(full_aql, bind_vars={'docs': collection_dict})
+        if len(collection_dict.keys()) > 1:
+            aql_return = 'UNION({0})'.format(','.join([k + '_result' for k in collection_dict.keys()]))
+        else:
+            aql_return = list(collection_dict.keys())[0] + '_result'
+        full_aql += 'FOR r in ' + aql_return + ' RETURN r'
+
+        def on_result(result):
             for i, r in enumerate(result):
                 order[i].update(r)
+        return full_aql, {'bind_vars': {'docs': collection_dict}}, on_result
+
+    def _query_op_statement(self, op):
+        if op[1] == 'execute':
+            q: RawQuery = op[0]
+            return q.query, q.kwargs, None
+        if op[1] == 'delete':
+            aql = op[0]._make_aql()
+            aql += "\n REMOVE {_key: rec._key} IN @@collection"
+            return aql, {'bind_vars': op[0]._bind_vars}, None
+        if op[1] == 'update':
+            aql, bind_vars = op[0]._make_update_aql()
 
+            def on_result(result):
+                op[0]._updated_rows = list(result)
+            return aql, {'bind_vars': bind_vars}, on_result
+
+    def _plan(self, insertions, changes, removed, query_ops):
+        # statements are built lazily: the documents of an insert batch can only be
+        # dumped once the keys of the batches they reference are known
+        plan = []
         for op in query_ops:
-            if op[1] == 'execute':
-                q: RawQuery = op[0]
-                tx.aql.execute(q.query, **q.kwargs)
             if op[1] == 'delete':
-                aql = op[0]._make_aql()
-                aql += "\n REMOVE {_key: rec._key} IN @@collection"
-                tx.aql.execute(aql, bind_vars=op[0]._bind_vars)
+                plan.append(lambda op=op: self._query_op_statement(op))
+        removed_keys = {}
+        for n in removed:
+            removed_keys.setdefault(n.__collection__, []).append(n._key)
+        for collection, keys in removed_keys.items():
+            bind_vars = {'keys': keys, '@collection': collection}
+            plan.append(lambda b=bind_vars: ('FOR k IN @keys REMOVE k IN @@collection', {'bind_vars': b}, None))
+        for batch in insertions:
+            if len(batch):
+                plan.append(lambda batch=batch: self._insert_statement(batch))
+        for batch in changes:
+            if len(batch):
+                plan.append(lambda batch=batch: self._update_statement(batch))
+        for op in query_ops:
+            if op[1] in ('execute', 'update'):
+                plan.append(lambda op=op: self._query_op_statement(op))
+        return plan
+
+    @staticmethod
+    def _assign_keys(new):
+        for e in new:
+            if not e._key:
+                e._data['_key'] = uuid.uuid4().hex
+            if not e._id:
+                e._data['_id'] = e.__collection__ + '/' + e._key
+
+    _single_round_trip_command = """
+        function (params) {
+            var db = require('@arangodb').db;
+            return params.statements.map(function (s) {
+                return db._query(s.aql, s.bindVars || {}).toArray();
+            });
+        }
+    """
+
+    def commit(self, new, changes, removed, query_ops: List[Tuple['ArangoStoreQuery', str]], single_round_trip=False):
+        # keys assigned up front and results of earlier statements are written into the entities,
+        # a failed commit restores them so that nothing looks persisted that is not
+        undo = [self._entity_undo(e) for e in chain(new, changes)]
+        try:
+            self._commit(new, changes, removed, query_ops, single_round_trip)
+        except Exception:
+            for fn in undo:
+                fn()
+            raise
+
+    def _commit(self, new, changes, removed, query_ops, single_round_trip):
+        timed = bool(instrumentation.instruments)
+        if timed:
+            start = time.perf_counter()
+        if single_round_trip:
+            # with the keys assigned up front every reference can be dumped right away,
+            # so all documents go into one layer
+            self._assign_keys(new)
+            insertions = [list(new)]
+            changes = [list(changes)]
+        else:
+            collected = set()
+            insertions = self._compute_batch_order(new, collected)
+            changes = self._compute_batch_order(changes, collected)
+        collections = set((e.__collection__ for b in insertions for e in b))
+        collections = collections | (set((e.__collection__ for b in changes for e in b)))
+        collections = collections | (set((e.__collection__ for e in removed)))
+        collections = collections | set(coll for ops in query_ops for coll in ops[2])
+        plan = self._plan(insertions, changes, removed, query_ops)
+        if timed:
+            instrumentation.emit('commit_phase', 'plan', time.perf_counter() - start)
+
+        if single_round_trip:
+            statements = [build() for build in plan]
+            if not statements:
+                return
+            params = {'statements': [{'aql': aql, 'bindVars': kwargs.get('bind_vars', None)} for aql, kwargs, on_result in statements]}
+            if timed:
+                start = time.perf_counter()
+            results = self.execute_transaction(self._single_round_trip_command, params=params, write=list(collections))
+            if timed:
+                bytes_sent = len(json.dumps(params, default=str))
+                instrumentation.emit('statement', 'transaction', time.perf_counter() - start, bytes_sent, len(results))
+                instrumentation.emit('commit_phase', 'transaction_commit', time.perf_counter() - start)
+            for (aql, kwargs, on_result), result in zip(statements, results):
+                if on_result:
+                    on_result(result)
+            return
+
+        if timed:
+            start = time.perf_counter()
+        tx = self.begin_transaction(write=list(collections))
+        if timed:
+            instrumentation.emit('commit_phase', 'begin', time.perf_counter() - start)
+        try:
+            for build in plan:
+                aql, kwargs, on_result = build()
+                result = self._execute(tx, aql, **kwargs)
+                if on_result:
+                    on_result(result)
+        except Exception:
+            tx.abort_transaction()
+            raise
+        if timed:
+            start = time.perf_counter()
         tx.commit_transaction()
+        if timed:
+            instrumentation.emit('commit_phase', 'transaction_commit', time.perf_counter() - start)
 
     def setup_db(self, models, graphs=[]):
         print('creating models', [m.__collection__ for m in models])
@@ -185,6 +252,26 @@ class ArangoDatabase(Database, AbstractDatabase):
             except exceptions.GraphCreateError as e:
                 if e.http_code != 409: raise e
 
+        return {m.__collection__: self._setup_indexes(m) for m in models}
+
+    def _setup_indexes(self, model) -> IndexReport:
+        col = self.collection(model.__collection__)
+        existing = [i for i in col.indexes() if i.get('type', None) not in ('primary', 'edge')]
+        created = []
+        for index in model._indexes:
+            if any(index.matches(e) for e in existing):
+                continue
+            if index.type == 'ttl':
+                col.add_ttl_index(index.fields, index.expire_after, name=index.name)
+            else:
+                col.add_persistent_index(index.fields, unique=index.unique, sparse=index.sparse, name=index.name)
+            created.append(index)
+        undeclared = [e for e in existing if not any(i.matches(e) for i in model._indexes)]
+        return IndexReport(created, [i for i in model._indexes if i not in created], undeclared)
+
+    def bulk_import(self, collection, docs, on_duplicate='error'):
+        return self.collection(collection).import_bulk(docs, on_duplicate=on_duplicate)
+
     def _verify_collection(self, col):
         return
 
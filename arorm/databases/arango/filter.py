@@ -1,66 +1,106 @@
+import itertools
+
+from arorm.databases.abstract import Filter
 from arorm.databases.arango.query import ArangoStoreQuery
 
 
 class ArangoFilter:
-    def __init__(self, name, op, var):
+    def __init__(self, name, op, var, counter=None):
         self.vars = {}
-        self.expression = ''
         self.or_ = False
-        self.prepend = True
+        self.prepend = False
         self.rec_name = None
-        getattr(self, op)(name, var)
+        # bind variables are numbered per query, so filters on the same path do not collide
+        self.counter = counter or itertools.count()
+        self.expression = self.compile(name, op, var)
+
+    def bind(self, value):
+        v = 'f' + str(next(self.counter))
+        self.vars[v] = value
+        return '@' + v
+
+    def value(self, value):
+        if isinstance(value, ArangoStoreQuery):
+            aql, bind_vars = value._subquery('sub' + str(next(self.counter)))
+            self.vars.update(bind_vars)
+            return aql
+        return self.bind(value)
+
+    def compile(self, name, op, var):
+        if op == 'and_':
+            return '(' + ' AND '.join(self.compile(f.name, f.op, f.var) for f in self.merge_ranges(var)) + ')'
+        if op == 'or_':
+            return '(' + ' OR '.join(self.compile(f.name, f.op, f.var) for f in var) + ')'
+        if op == 'not_':
+            return 'NOT (' + self.compile(var.name, var.op, var.var) + ')'
+        return getattr(self, op)(name, var)
+
+    @staticmethod
+    def merge_ranges(filters):
+        # keep only the tightest lower and upper bound per path, next to each other,
+        # so the optimizer sees a single range
+        lower = {}
+        upper = {}
+        rest = []
+        for f in filters:
+            bounds = lower if f.op in ('ge', 'gt') else upper if f.op in ('le', 'lt') else None
+            if bounds is None or f.var is None:
+                rest.append(f)
+                continue
+            current = bounds.get(f.name, None)
+            try:
+                if current is None:
+                    bounds[f.name] = f
+                elif f.var == current.var:
+                    if f.op in ('gt', 'lt'):
+                        bounds[f.name] = f
+                elif (f.var > current.var) == (bounds is lower):
+                    bounds[f.name] = f
+            except TypeError:
+                rest.append(f)
+        ranges = []
+        for name in list(lower.keys()) + [n for n in upper.keys() if n not in lower]:
+            ranges += [b[name] for b in (lower, upper) if name in b]
+        return ranges + rest
 
     def eq(self, name: str, var):
-        v = name.replace('.', '_')
-        self.expression = '{0}==@{1}'.format(name, v)
-        self.vars[v] = var
+        return 'rec.{0} == {1}'.format(name, self.bind(var))
 
     def le(self, name, var):
-        v = name.replace('.', '_')
-        self.expression = '{0}<=@{1}'.format(name, v)
-        self.vars[v] = var
+        return 'rec.{0} <= {1}'.format(name, self.bind(var))
 
     def ge(self, name, var):
-        v = name.replace('.', '_')
-        self.expression = '{0}>=@{1}'.format(name, v)
-        self.vars[v] = var
+        return 'rec.{0} >= {1}'.format(name, self.bind(var))
 
     def lt(self, name, var):
-        v = name.replace('.', '_')
-        self.expression = '{0}<@{1}'.format(name, v)
-        self.vars[v] = var
+        return 'rec.{0} < {1}'.format(name, self.bind(var))
 
     def gt(self, name, var):
-        v = name.replace('.', '_')
-        self.expression = '{0}>@{1}'.format(name, v)
-        self.vars[v] = var
+        return 'rec.{0} > {1}'.format(name, self.bind(var))
 
     def in_(self, name, var):
-        v = name.replace('.', '_')
         b, is_in = var
-        self.expression = f'CONTAINS_ARRAY(@{v}_in, rec.{name}) == {is_in}'
-        self.vars[v+'_in'] = isinstance(b, ArangoStoreQuery) and b._make_aql() or b
-        self.prepend = False
+        return f'rec.{name} {is_in and "IN" or "NOT IN"} {self.value(b)}'
 
     def len_eq(self, name, var):
-        v = name.replace('.', '_')
-        self.expression = 'LENGTH(rec.{0})==@{1}'.format(name, v + '_count')
-        self.vars[v + '_count'] = var
-        self.prepend = False
+        return 'LENGTH(rec.{0}) == {1}'.format(name, self.bind(var))
 
     def contains_(self, name, var):
-        v = name.replace('.', '_')
         b, is_in = var
-        self.expression = f'CONTAINS_ARRAY(rec.{name}, @{v}_in) == {is_in}'
-        self.vars[v +'_in'] = isinstance(b, ArangoStoreQuery) and b._make_aql() or b
-        self.prepend = False
+        v = self.value(b)
+        # a subquery returns an array, so it behaves like a list
+        if isinstance(b, (list, tuple, set, ArangoStoreQuery)):
+            expression = f'{v} ALL IN rec.{name}'
+        else:
+            # the expanded form can use an array index on name[*]
+            expression = f'{v} IN rec.{name}[*]'
+        return is_in and expression or f'NOT ({expression})'
 
     def has_prop(self, name, var):
         sub_name, val = var
-        v = sub_name.replace('.', '_')
-        self.expression = f'rec.{name}.{sub_name} == @{v}_val'
-        self.vars[v+'_val'] = isinstance(val, ArangoStoreQuery) and val._make_aql() or val
-        self.prepend = False
+        if isinstance(val, ArangoStoreQuery):
+            return f'rec.{name}.{sub_name} IN {self.value(val)}'
+        return f'rec.{name}.{sub_name} == {self.bind(val)}'
 
 
 def filter(self, *args, **kwargs):
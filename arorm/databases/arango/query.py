@@ -1,12 +1,47 @@
+import itertools
+import re
+import time
 import typing
+from collections import namedtuple
 
 from arango_orm.exceptions import DocumentNotFoundError
 
-from core.orm.databases.abstract import Filter, RawQuery, StoreQuery
+from arorm.databases.abstract import Aggregate, Expression, Filter, RawQuery, StoreQuery, check_options, \
+    decode_page_token
 from arango_orm.query import Query as ArangoQuery
 
+from arorm import indexes, instrumentation
+
 if typing.TYPE_CHECKING:
-    from core.orm import Store, Model
+    from arorm import Store, Model
+
+
+# string literals are matched so that their content is left alone
+_subquery_token_re = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|@@?\w+|(?<![.\w])(?:rec|sub\d+(?:_sub\d+)*)\b')
+
+
+def execute(db, aql, on_cursor=None, **kwargs):
+    if not instrumentation.instruments:
+        cursor = db.aql.execute(aql, **kwargs)
+        if on_cursor:
+            on_cursor(cursor)
+        return cursor
+    bind_vars = kwargs.get('bind_vars', None)
+    instrumentation.emit('query_start', aql, bind_vars)
+    start = time.perf_counter()
+    cursor = db.aql.execute(aql, **kwargs)
+    if on_cursor:
+        on_cursor(cursor)
+
+    def rows():
+        count = 0
+        try:
+            for r in cursor:
+                count += 1
+                yield r
+        finally:
+            instrumentation.emit('query_end', aql, bind_vars, time.perf_counter() - start, count)
+    return rows()
 
 
 class ArRawQuery(RawQuery):
@@ -15,66 +50,204 @@ class ArRawQuery(RawQuery):
         self.query = query
         self.kwargs = kwargs
 
+    def options(self, **options):
+        self.kwargs.update(check_options(options))
+        return self
+
     def execute(self):
-        self.database.aql.execute(self.query, **self.kwargs)
+        for _ in execute(self.database, self.query, **self.kwargs):
+            pass
 
     def iter(self):
-        return self.database.aql.execute(self.query, **self.kwargs)
+        return execute(self.database, self.query, **self.kwargs)
 
     def all(self):
-        return [x for x in self.database.aql.execute(self.query, **self.kwargs)]
+        return [x for x in execute(self.database, self.query, **self.kwargs)]
 
     def scalar(self):
-        return next(self.database.aql.execute(self.query, **self.kwargs))
+        return next(execute(self.database, self.query, **self.kwargs))
 
     def one(self):
-        return next(self.database.aql.execute(self.query, **self.kwargs))
+        return next(execute(self.database, self.query, **self.kwargs))
 
 
 class ArangoStoreQuery(ArangoQuery, StoreQuery):
     def __init__(self, store: 'Store', entity_type: 'Model'):
-        super(ArangoStoreQuery, self).__init__(entity_type, store.database)
-        self.store = store
-        self.entity_type = entity_type
+        ArangoQuery.__init__(self, entity_type, store.database)
+        StoreQuery.__init__(self, store, entity_type)
+        self._filter_counter = itertools.count()
+        options = store.query_options
+        self._options = dict(options.get(None, {}), **options.get(entity_type.__collection__, {}))
+        # cursor statistics of the last execution, e.g. fullCount with options(full_count=True)
+        self.statistics = None
 
-    def get(self, id):
-        return self.store.get(self.entity_type, id)
+    @property
+    def _db(self):
+        # reads are routed by the store, to a read endpoint unless a collection of this query is pinned
+        return self.store.read_database([v for k, v in self._bind_vars.items() if k[0] == '@'])
+
+    @_db.setter
+    def _db(self, db):
+        pass
+
+    def options(self, **options):
+        self._options.update(check_options(options))
+        return self
+
+    def _set_cursor(self, cursor):
+        self.statistics = cursor.statistics()
+
+    def _execute(self, aql, **kwargs):
+        kwargs = dict(self._options, **{k: v for k, v in kwargs.items() if v is not None})
+        start = time.perf_counter()
+        try:
+            cursor = execute(self._db, aql, on_cursor=self._set_cursor, **kwargs)
+        except Exception:
+            self.store._query_done(time.perf_counter() - start)
+            raise
+        return self._timed(cursor, start)
+
+    def _timed(self, cursor, start):
+        # the query time includes fetching the later batches of the cursor
+        try:
+            yield from cursor
+        finally:
+            self.store._query_done(time.perf_counter() - start)
 
     def find_one(self, id):
+        start = time.perf_counter()
         try:
             obj = super(ArangoStoreQuery, self).by_key(id)
-            obj = self.store.add(obj)
         except DocumentNotFoundError as e:
             return None
-        return obj
+        finally:
+            self.store._query_done(time.perf_counter() - start)
+        return self.store.add(obj)
+
+    def find_many(self, keys):
+        return self._hydrate(self.fetch_many(keys))
+
+    def fetch_many(self, keys):
+        aql = 'FOR rec IN @@collection FILTER rec._key IN @keys RETURN rec'
+        bind_vars = {'@collection': self._bind_vars['@collection'], 'keys': list(keys)}
+        return list(self._execute(aql, bind_vars=bind_vars))
+
+    def revisions(self, keys):
+        aql = 'FOR rec IN @@collection FILTER rec._key IN @keys RETURN [rec._key, rec._rev]'
+        bind_vars = {'@collection': self._bind_vars['@collection'], 'keys': list(keys)}
+        return dict(self._execute(aql, bind_vars=bind_vars))
 
     def all(self):
-        values = super(ArangoStoreQuery, self).all()
-        values = [self.store.add(obj) for obj in values]
-        return values
+        if self._return_fields is not None:
+            return [self.store.add(obj) for obj in super(ArangoStoreQuery, self).all()]
+        return self._hydrate(self._fetch())
+
+    def _fetch(self):
+        return list(self._execute(self._make_aql() + '\n RETURN rec', bind_vars=self._bind_vars))
+
+    def iter_raw(self, batch_size=None, fields=None):
+        aql = self._make_aql()
+        bind_vars = dict(self._bind_vars)
+        if fields:
+            aql += '\n RETURN KEEP(rec, @raw_fields)'
+            bind_vars['raw_fields'] = ['_id', '_key', '_rev'] + [f for f in fields if f not in ('_id', '_key', '_rev')]
+        else:
+            aql += '\n RETURN rec'
+        return self._execute(aql, bind_vars=bind_vars, batch_size=batch_size, stream=True)
+
+    def _column_rows(self, paths, batch_size=None):
+        aql = self._make_aql() + '\n RETURN [' + ', '.join('rec.' + path for path in paths) + ']'
+        return self._execute(aql, bind_vars=self._bind_vars, batch_size=batch_size, stream=True)
+
+    def aggregate(self, **aggregates):
+        functions = {
+            'count': 'LENGTH(1)',
+            'count_distinct': 'COUNT_DISTINCT(rec.{0})',
+            'sum': 'SUM(rec.{0})',
+            'min': 'MIN(rec.{0})',
+            'max': 'MAX(rec.{0})',
+            'avg': 'AVERAGE(rec.{0})',
+        }
+        collect = ', '.join(f'g{i} = rec.{path}' for i, (name, path) in enumerate(self._group_by))
+        aggregate = []
+        for i, (name, a) in enumerate(aggregates.items()):
+            if not isinstance(a, Aggregate) or a.op not in functions:
+                raise Exception('not an aggregate: ' + str(a))
+            aggregate.append(f'a{i} = ' + functions[a.op].format(a.name))
+        aql = self._make_aql() + '\n COLLECT ' + collect
+        if aggregate:
+            aql += ' AGGREGATE ' + ', '.join(aggregate)
+        names = [name for name, path in self._group_by] + list(aggregates.keys())
+        values = [f'g{i}' for i in range(len(self._group_by))] + [f'a{i}' for i in range(len(aggregates))]
+        aql += '\n RETURN [' + ', '.join(values) + ']'
+        Row = namedtuple(self.entity_type.__name__ + 'Row', names, rename=True)
+        return [Row(*r) for r in self._execute(aql, bind_vars=self._bind_vars)]
+
+    def sort(self, col_name, desc=False):
+        if not isinstance(col_name, str):
+            col_name = col_name.get_property_path() + (desc and ' DESC' or '')
+        return super(ArangoStoreQuery, self).sort(col_name)
+
+    def paginate(self, after=None, limit=100):
+        keys = self._page_keys()
+        if after is not None:
+            values = decode_page_token(after)
+            conditions = []
+            for i, (path, desc) in enumerate(keys):
+                condition = [f'rec.{p} == @_page_{j}' for j, (p, d) in enumerate(keys[:i])]
+                condition.append(f'rec.{path} {desc and "<" or ">"} @_page_{i}')
+                conditions.append('(' + ' AND '.join(condition) + ')')
+            # a FILTER statement of its own, so it is ANDed with all existing conditions, also those joined with _or
+            self._filter_conditions.append(dict(condition='(' + ' OR '.join(conditions) + ')', joiner=None,
+                                                prepend_rec_name=False, rec_name_placeholder=None))
+            self._bind_vars.update({f'_page_{i}': v for i, v in enumerate(values)})
+        self.limit(limit + 1)
+        rows = list(self._execute(self._make_aql() + '\n RETURN rec', bind_vars=self._bind_vars))
+        return self._page(rows, keys, limit)
 
     def make_aql(self):
         return super(ArangoStoreQuery, self)._make_aql()
 
     def count(self):
-        return super(ArangoStoreQuery, self).count()
+        aql = self._make_aql() + '\n COLLECT WITH COUNT INTO rec_count RETURN rec_count'
+        return list(self._execute(aql, bind_vars=self._bind_vars))[0]
+
+    def _subquery(self, name):
+        """this query as an inline subquery returning one field, with rec and the bind vars renamed after name"""
+        if self._return_fields and len(self._return_fields) > 1:
+            raise Exception('a subquery can only return a single field')
+        field = self._return_fields and self._return_fields[0]._name or '_key'
+
+        def rename(m):
+            token = m.group(0)
+            if token == 'rec':
+                return name
+            if token.startswith('@'):
+                at = token[:2] == '@@' and '@@' or '@'
+                return at + name + '_' + token[len(at):]
+            if token.startswith('sub'):
+                # variables of nested subqueries
+                return name + '_' + token
+            return token
+        aql = _subquery_token_re.sub(rename, self._make_aql() + '\n RETURN rec.' + field)
+        bind_vars = {(k[0] == '@' and '@' + name + '_' + k[1:] or name + '_' + k): v for k, v in self._bind_vars.items()}
+        return '(' + aql + ')', bind_vars
 
     @staticmethod
     def raw(database, query, **kwargs):
         return ArRawQuery(database, query, kwargs)
 
     def aql(self, query, **kwargs):
-        print("aql", query)
-        for obj in super(ArangoStoreQuery, self).aql(query, **kwargs):
-            obj = self.store.add(obj)
-            yield obj
+        kwargs['bind_vars'] = dict(kwargs.get('bind_vars', None) or {}, **{'@collection': self._bind_vars['@collection']})
+        yield from self._hydrate(self._execute(query, **kwargs))
 
     def filter(self, *args, **kwargs):
-        from core.orm.databases.arango import ArangoFilter
+        from arorm.databases.arango import ArangoFilter
         for arg in args:
             if isinstance(arg, Filter):
-                f = ArangoFilter(arg.name, arg.op, arg.var)
-                print('filter', f.expression, arg.prepend, arg.or_)
+                if self.store.warn_unindexed:
+                    indexes.warn_unindexed(self.entity_type, arg)
+                f = ArangoFilter(arg.name, arg.op, arg.var, self._filter_counter)
                 super(ArangoStoreQuery, self).filter(f.expression, _or=arg.or_, prepend_rec_name=f.prepend, **f.vars)
             else:
                 if not isinstance(arg, str):
@@ -82,6 +255,40 @@ class ArangoStoreQuery(ArangoQuery, StoreQuery):
                 super(ArangoStoreQuery, self).filter(arg, **kwargs)
         return self
 
-    def delete(self):
-        self.store.queue_ops.append([self, 'delete', [self.entity_type.__collection__]])
-        return self
+    # arango_orm's Query has its own delete and update, which come first in the mro
+    delete = StoreQuery.delete
+    update = StoreQuery.update
+
+    def _make_update_aql(self):
+        operators = {'add': '+', 'sub': '-', 'mul': '*', 'div': '/'}
+        bind_vars = dict(self._bind_vars)
+        tree = {}
+        for i, (path, value) in enumerate(self._update_values.items()):
+            v = f'_up_{i}'
+            if isinstance(value, Expression):
+                expression = f'rec.{value.name} {operators[value.op]} @{v}'
+                value = value.var
+            else:
+                expression = f'@{v}'
+                field = self.entity_type._fields.get(path, None)
+                if field is not None and value is not None:
+                    value = field.to_db(value)
+            bind_vars[v] = value
+            node = tree
+            parts = path.split('.')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = expression
+
+        def to_aql(node):
+            return '{' + ', '.join(f'`{k}`: ' + (to_aql(v) if isinstance(v, dict) else v) for k, v in node.items()) + '}'
+
+        aql = self._make_aql()
+        aql += '\n UPDATE rec WITH ' + to_aql(tree) + ' IN @@collection OPTIONS { mergeObjects: true }'
+        # only documents in the identity map need their new values, the rest of the matched set stays on the server
+        cached = [e._id for e in self.store._cache_by_type.get(self.entity_type.__collection__, []) if e._id]
+        if cached:
+            bind_vars['_up_keys'] = ['_id', '_rev'] + list(tree.keys())
+            bind_vars['_up_cached'] = cached
+            aql += '\n FILTER NEW._id IN @_up_cached RETURN KEEP(NEW, @_up_keys)'
+        return aql, bind_vars
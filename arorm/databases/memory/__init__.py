@@ -0,0 +1,240 @@
+import bisect
+import copy
+import itertools
+import threading
+from typing import Dict, List, Tuple
+
+from arorm.databases.abstract import DatabaseFactory, AbstractDatabase
+from arorm.indexes import Index, IndexReport
+from arorm.databases.memory.filter import MemoryFilter, get_path, hashable, sort_key
+from arorm.databases.memory.query import MemoryStoreQuery
+
+
+class SortedIndex:
+    def __init__(self, path):
+        self.path = path
+        self.values = []
+        self.keys = []
+
+    def add(self, doc):
+        v = sort_key(get_path(doc, self.path))
+        i = bisect.bisect_right(self.values, v)
+        self.values.insert(i, v)
+        self.keys.insert(i, doc['_key'])
+
+    def remove(self, doc):
+        v = sort_key(get_path(doc, self.path))
+        start = bisect.bisect_left(self.values, v)
+        end = bisect.bisect_right(self.values, v)
+        i = self.keys.index(doc['_key'], start, end)
+        del self.values[i]
+        del self.keys[i]
+
+    def range(self, op, value):
+        v = sort_key(value)
+        if op == 'gt':
+            return self.keys[bisect.bisect_right(self.values, v):]
+        if op == 'ge':
+            return self.keys[bisect.bisect_left(self.values, v):]
+        if op == 'lt':
+            return self.keys[:bisect.bisect_left(self.values, v)]
+        return self.keys[:bisect.bisect_right(self.values, v)]
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.documents: Dict[str, dict] = {}
+        self.hash_indexes: Dict[str, Dict[object, set]] = {}
+        self.sorted_indexes: Dict[str, SortedIndex] = {}
+        # declared indexes, only used for reporting; lookups build their indexes on demand
+        self.indexes: List[Index] = []
+
+    def hash_index(self, path):
+        if path not in self.hash_indexes:
+            index = self.hash_indexes[path] = {}
+            for doc in self.documents.values():
+                index.setdefault(hashable(get_path(doc, path)), set()).add(doc['_key'])
+        return self.hash_indexes[path]
+
+    def sorted_index(self, path):
+        if path not in self.sorted_indexes:
+            index = self.sorted_indexes[path] = SortedIndex(path)
+            for doc in self.documents.values():
+                index.add(doc)
+        return self.sorted_indexes[path]
+
+    def insert(self, doc):
+        if doc['_key'] in self.documents:
+            raise Exception('unique constraint violated: ' + doc['_id'])
+        self.documents[doc['_key']] = doc
+        for path, index in self.hash_indexes.items():
+            index.setdefault(hashable(get_path(doc, path)), set()).add(doc['_key'])
+        for index in self.sorted_indexes.values():
+            index.add(doc)
+
+    def remove(self, key):
+        doc = self.documents.pop(key)
+        for path, index in self.hash_indexes.items():
+            keys = index.get(hashable(get_path(doc, path)))
+            keys.discard(key)
+            if not keys:
+                del index[hashable(get_path(doc, path))]
+        for index in self.sorted_indexes.values():
+            index.remove(doc)
+        return doc
+
+    def replace(self, doc):
+        self.remove(doc['_key'])
+        self.insert(doc)
+
+
+def merge(doc, changes):
+    for k, v in changes.items():
+        if isinstance(v, dict) and isinstance(doc.get(k, None), dict):
+            merge(doc[k], v)
+        else:
+            doc[k] = v
+    return doc
+
+
+class MemoryDatabase(AbstractDatabase):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections: Dict[str, MemoryCollection] = {}
+        self._keys = itertools.count(1)
+        self._revs = itertools.count(1)
+
+    def collection(self, name) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def _next_rev(self):
+        return '_' + str(next(self._revs))
+
+    def _insert(self, entity):
+        doc = copy.deepcopy(entity._dump())
+        key = doc.get('_key', None) or str(next(self._keys))
+        doc.update(_key=key, _id=entity.__collection__ + '/' + key, _rev=self._next_rev())
+        self.collection(entity.__collection__).insert(doc)
+        return {'_id': doc['_id'], '_key': key, '_rev': doc['_rev']}
+
+    def _update(self, entity):
+        collection = self.collection(entity.__collection__)
+        doc = copy.deepcopy(collection.documents[entity._key])
+        changes = copy.deepcopy(entity._dump(changes_only=True))
+        changes.pop('_rev', None)
+        merge(doc, changes)
+        doc['_rev'] = self._next_rev()
+        collection.replace(doc)
+        return {'_id': doc['_id'], '_key': doc['_key'], '_rev': doc['_rev']}
+
+    def _run_query_op(self, op, undo):
+        if op[1] == 'execute':
+            return op[0].execute()
+        q: MemoryStoreQuery = op[0]
+        collection = self.collection(q.entity_type.__collection__)
+        if op[1] == 'delete':
+            for doc in q._rows():
+                collection.remove(doc['_key'])
+                undo.append(lambda c=collection, d=doc: c.insert(d))
+        if op[1] == 'update':
+            keys = ['_id', '_rev'] + list(set(path.split('.')[0] for path in q._update_values))
+            q._updated_rows = []
+            for old in q._rows():
+                doc = q._apply_update(old)
+                doc['_rev'] = self._next_rev()
+                collection.replace(doc)
+                undo.append(lambda c=collection, d=old: c.replace(d))
+                if doc['_id'] in q.store._cache:
+                    q._updated_rows.append({k: copy.deepcopy(doc.get(k, None)) for k in keys})
+
+    def commit(self, new, changes, removed, query_ops: List[Tuple['MemoryStoreQuery', str]], single_round_trip=False):
+        # documents are only replaced, never changed in place, so the undo log can keep the old ones
+        # and a failed commit leaves the database and the entities as they were, like an aborted transaction
+        with self.lock:
+            undo = []
+            try:
+                self._commit(new, changes, removed, query_ops, undo)
+            except Exception:
+                for fn in reversed(undo):
+                    fn()
+                raise
+
+    def _commit(self, new, changes, removed, query_ops, undo):
+        collected = set()
+        insertions = self._compute_batch_order(new, collected)
+        changes = self._compute_batch_order(changes, collected)
+        # same order as ArangoDatabase._plan: queued deletes, removals, inserts, changes, then the other ops
+        for op in query_ops:
+            if op[1] == 'delete':
+                self._run_query_op(op, undo)
+        for n in removed:
+            collection = self.collection(n.__collection__)
+            doc = collection.remove(n._key)
+            undo.append(lambda c=collection, d=doc: c.insert(d))
+        for batch in insertions:
+            for b in batch:
+                if b._rev:
+                    raise Exception('cannot be new')
+                undo.append(self._entity_undo(b))
+                result = self._insert(b)
+                undo.append(lambda c=self.collection(b.__collection__), k=result['_key']: c.remove(k))
+                b.update(result)
+                b._dirty.clear()
+        for batch in changes:
+            for b in batch:
+                collection = self.collection(b.__collection__)
+                undo.append(self._entity_undo(b))
+                old = collection.documents[b._key]
+                result = self._update(b)
+                undo.append(lambda c=collection, d=old: c.replace(d))
+                b.update(result)
+        for op in query_ops:
+            if op[1] in ('execute', 'update'):
+                self._run_query_op(op, undo)
+
+    def setup_db(self, models, graphs=[]):
+        report = {}
+        for m in models:
+            collection = self.collection(m.__collection__)
+            created = [i for i in m._indexes if i not in collection.indexes]
+            collection.indexes += created
+            report[m.__collection__] = IndexReport(created, [i for i in m._indexes if i not in created], [
+                i for i in collection.indexes if i not in m._indexes])
+        return report
+
+    def bulk_import(self, collection, docs, on_duplicate='error'):
+        with self.lock:
+            c = self.collection(collection)
+            for doc in docs:
+                doc = copy.deepcopy(doc)
+                key = doc.get('_key', None) or str(next(self._keys))
+                doc.update(_key=key, _id=collection + '/' + key, _rev=self._next_rev())
+                if key in c.documents:
+                    if on_duplicate == 'ignore':
+                        continue
+                    if on_duplicate == 'update':
+                        doc = merge(copy.deepcopy(c.documents[key]), doc)
+                    if on_duplicate == 'error':
+                        raise Exception('unique constraint violated: ' + doc['_id'])
+                    c.remove(key)
+                c.insert(doc)
+
+
+class MemoryDatabaseFactory(DatabaseFactory):
+    Query = MemoryStoreQuery
+    Filter = MemoryFilter
+
+    # databases created with a db_name are shared by all stores using that name
+    databases: Dict[str, MemoryDatabase] = {}
+
+    @staticmethod
+    def create_database(settings):
+        name = getattr(settings, 'db_name', None)
+        if name is None:
+            return MemoryDatabase()
+        if name not in MemoryDatabaseFactory.databases:
+            MemoryDatabaseFactory.databases[name] = MemoryDatabase()
+        return MemoryDatabaseFactory.databases[name]
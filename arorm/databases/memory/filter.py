@@ -0,0 +1,129 @@
+from arorm.databases.abstract import StoreQuery
+
+
+def get_path(doc, path):
+    v = doc
+    for p in path.split('.'):
+        if not isinstance(v, dict):
+            return None
+        v = v.get(p, None)
+    return v
+
+
+def sort_key(v):
+    # follows the AQL type order: null < bool < number < string < array < object
+    if v is None:
+        return (0,)
+    if isinstance(v, bool):
+        return (1, v)
+    if isinstance(v, (int, float)):
+        return (2, v)
+    if isinstance(v, str):
+        return (3, v)
+    if isinstance(v, (list, tuple)):
+        return (4, tuple(sort_key(x) for x in v))
+    if isinstance(v, dict):
+        return (5, tuple(sorted((k, sort_key(x)) for k, x in v.items())))
+    return (6, str(v))
+
+
+def hashable(v):
+    if isinstance(v, (list, tuple)):
+        return tuple(hashable(x) for x in v)
+    if isinstance(v, dict):
+        return tuple(sorted((k, hashable(x)) for k, x in v.items()))
+    return v
+
+
+def query_values(var):
+    if isinstance(var, StoreQuery):
+        return set(d['_key'] for d in var._rows())
+    return var
+
+
+class MemoryFilter:
+    def __init__(self, name, op, var):
+        self.name = name
+        self.op = op
+        self.var = var
+        if op in ('and_', 'or_'):
+            self.var = [MemoryFilter(f.name, f.op, f.var) for f in var]
+        if op == 'not_':
+            self.var = MemoryFilter(var.name, var.op, var.var)
+        if op in ('in_', 'contains_'):
+            b, is_in = var
+            self.var = (query_values(b), is_in)
+        if op == 'has_prop':
+            sub_name, val = var
+            self.var = (sub_name, query_values(val))
+        self.matches = getattr(self, op)
+
+    def and_(self, doc):
+        return all(f.matches(doc) for f in self.var)
+
+    def or_(self, doc):
+        return any(f.matches(doc) for f in self.var)
+
+    def not_(self, doc):
+        return not self.var.matches(doc)
+
+    def eq(self, doc):
+        return get_path(doc, self.name) == self.var
+
+    def le(self, doc):
+        return sort_key(get_path(doc, self.name)) <= sort_key(self.var)
+
+    def ge(self, doc):
+        return sort_key(get_path(doc, self.name)) >= sort_key(self.var)
+
+    def lt(self, doc):
+        return sort_key(get_path(doc, self.name)) < sort_key(self.var)
+
+    def gt(self, doc):
+        return sort_key(get_path(doc, self.name)) > sort_key(self.var)
+
+    def in_(self, doc):
+        b, is_in = self.var
+        return (get_path(doc, self.name) in b) == is_in
+
+    def contains_(self, doc):
+        b, is_in = self.var
+        values = get_path(doc, self.name) or []
+        if isinstance(b, (list, tuple, set)):
+            return all(v in values for v in b) == is_in
+        return (b in values) == is_in
+
+    def len_eq(self, doc):
+        return len(get_path(doc, self.name) or []) == self.var
+
+    def has_prop(self, doc):
+        sub_name, val = self.var
+        return get_path(doc, self.name + '.' + sub_name) == val
+
+    def candidates(self, collection):
+        """keys matching this filter from an index, or None if it cannot use one"""
+        if self.op == 'and_':
+            for f in self.var:
+                keys = f.candidates(collection)
+                if keys is not None:
+                    return keys
+            return None
+        if self.op == 'or_':
+            keys = set()
+            for f in self.var:
+                candidates = f.candidates(collection)
+                if candidates is None:
+                    return None
+                keys |= candidates
+            return keys
+        if self.op == 'eq':
+            return collection.hash_index(self.name).get(hashable(self.var), set())
+        if self.op == 'in_' and self.var[1] and isinstance(self.var[0], (list, tuple, set)):
+            index = collection.hash_index(self.name)
+            keys = set()
+            for v in self.var[0]:
+                keys |= index.get(hashable(v), set())
+            return keys
+        if self.op in ('le', 'ge', 'lt', 'gt'):
+            return set(collection.sorted_index(self.name).range(self.op, self.var))
+        return None
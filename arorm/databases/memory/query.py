@@ -0,0 +1,286 @@
+import bisect
+import copy
+import time
+import typing
+from collections import namedtuple
+
+from arorm import indexes
+from arorm.databases.abstract import Aggregate, Expression, Filter, RawQuery, StoreQuery, check_options, \
+    decode_page_token
+from arorm.databases.memory.filter import MemoryFilter, get_path, hashable, sort_key
+
+if typing.TYPE_CHECKING:
+    from arorm import Store, Model
+
+
+class MemoryRawQuery(RawQuery):
+    def __init__(self, database, query, kwargs):
+        self.database = database
+        self.query = query
+        self.kwargs = kwargs
+
+    def options(self, **options):
+        self.kwargs.update(check_options(options))
+        return self
+
+    def execute(self):
+        raise Exception('AQL queries are not supported by the memory driver')
+
+    iter = all = scalar = one = execute
+
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for p in parts[:-1]:
+        if not isinstance(doc.get(p, None), dict):
+            doc[p] = {}
+        doc = doc[p]
+    doc[parts[-1]] = value
+
+
+class MemoryStoreQuery(StoreQuery):
+    # results must not share the stored documents
+    _copy = staticmethod(copy.deepcopy)
+
+    def __init__(self, store: 'Store', entity_type: 'Model'):
+        super(MemoryStoreQuery, self).__init__(store, entity_type)
+        self._db = store.database
+        self._filters: typing.List[typing.Tuple[MemoryFilter, bool]] = []
+        self._sort_columns = []
+        self._limit = None
+        self._limit_start_record = 0
+
+    @property
+    def _collection(self):
+        return self._db.collection(self.entity_type.__collection__)
+
+    @staticmethod
+    def raw(database, query, **kwargs):
+        return MemoryRawQuery(database, query, kwargs)
+
+    def filter(self, *args, **kwargs):
+        for arg in args:
+            if not isinstance(arg, Filter):
+                raise Exception('the memory driver only supports Filter objects, got: ' + str(arg))
+            if self.store.warn_unindexed:
+                indexes.warn_unindexed(self.entity_type, arg)
+            self._filters.append((MemoryFilter(arg.name, arg.op, arg.var), arg.or_ or kwargs.get('_or', False)))
+        return self
+
+    def sort(self, col_name, desc=False):
+        if not isinstance(col_name, str):
+            col_name = col_name.get_property_path() + (desc and ' DESC' or '')
+        self._sort_columns.append(col_name)
+        return self
+
+    def limit(self, num_records, start_from=0):
+        self._limit = num_records
+        self._limit_start_record = start_from
+        return self
+
+    def _groups(self):
+        # AND binds stronger than OR, the same as the joined AQL filter conditions
+        groups = []
+        for f, or_ in self._filters:
+            if or_ or not groups:
+                groups.append([])
+            groups[-1].append(f)
+        return groups
+
+    def _candidates(self, collection, groups):
+        keys = set()
+        for group in groups:
+            candidates = None
+            for f in group:
+                candidates = f.candidates(collection)
+                if candidates is not None:
+                    break
+            if candidates is None:
+                return None
+            keys |= candidates
+        return keys
+
+    def _rows(self):
+        start = time.perf_counter()
+        try:
+            return self._find_rows()
+        finally:
+            self.store._query_done(time.perf_counter() - start)
+
+    @staticmethod
+    def _matches(doc, groups):
+        return any(all(f.matches(doc) for f in group) for group in groups)
+
+    def _sort(self, docs):
+        for sc in reversed(self._sort_columns):
+            parts = sc.split()
+            docs.sort(key=lambda d: sort_key(get_path(d, parts[0])), reverse=len(parts) > 1 and parts[1].upper() == 'DESC')
+        return docs
+
+    def _find_rows(self):
+        with self._db.lock:
+            collection = self._collection
+            groups = self._groups()
+            keys = self._candidates(collection, groups) if groups else None
+            docs = collection.documents.values() if keys is None else (collection.documents[k] for k in keys)
+            if groups:
+                docs = [d for d in docs if self._matches(d, groups)]
+            else:
+                docs = list(docs)
+        self._sort(docs)
+        if self._limit:
+            docs = docs[self._limit_start_record:self._limit_start_record + self._limit]
+        return docs
+
+    def options(self, **options):
+        # cursor options do not apply to in-memory results, they are only validated
+        check_options(options)
+        return self
+
+    def _documents(self, keys):
+        start = time.perf_counter()
+        try:
+            documents = self._collection.documents
+            return [documents[k] for k in keys if k in documents]
+        finally:
+            self.store._query_done(time.perf_counter() - start)
+
+    def find_one(self, id):
+        docs = self._documents([id.split('/')[-1]])
+        return docs and self._hydrate(docs)[0] or None
+
+    def find_many(self, keys):
+        return self._hydrate(self._documents(keys))
+
+    def fetch_many(self, keys):
+        return [copy.deepcopy(doc) for doc in self._documents(keys)]
+
+    def revisions(self, keys):
+        return {doc['_key']: doc['_rev'] for doc in self._documents(keys)}
+
+    def all(self):
+        return self._hydrate(self._rows())
+
+    def _fetch(self):
+        return self._rows()
+
+    def first(self):
+        rows = self.limit(1)._rows()
+        return rows and self._hydrate(rows)[0] or None
+
+    def one(self):
+        rows = self._rows()
+        assert 1 == len(rows)
+        return self._hydrate(rows)[0]
+
+    def count(self):
+        return len(self._rows())
+
+    def iter_raw(self, batch_size=None, fields=None):
+        for row in self._rows():
+            if fields:
+                row = {k: v for k, v in row.items() if k in fields or k in ('_id', '_key', '_rev')}
+            yield copy.deepcopy(row)
+
+    def _column_rows(self, paths, batch_size=None):
+        for row in self._rows():
+            yield copy.deepcopy([get_path(row, path) for path in paths])
+
+    def make_aql(self):
+        raise Exception('make_aql is not supported by the memory driver')
+
+    def aql(self, query, **kwargs):
+        raise Exception('AQL queries are not supported by the memory driver')
+
+    def _apply_update(self, doc):
+        operators = {
+            'add': lambda a, b: (a or 0) + b,
+            'sub': lambda a, b: (a or 0) - b,
+            'mul': lambda a, b: (a or 0) * b,
+            'div': lambda a, b: (a or 0) / b,
+        }
+        doc = copy.deepcopy(doc)
+        for path, value in self._update_values.items():
+            if isinstance(value, Expression):
+                value = operators[value.op](get_path(doc, value.name), value.var)
+            field = self.entity_type._fields.get(path, None)
+            if field is not None and value is not None:
+                value = field.to_db(value)
+            set_path(doc, path, copy.deepcopy(value))
+        return doc
+
+    def aggregate(self, **aggregates):
+        def numbers(rows, name):
+            return [v for v in (get_path(r, name) for r in rows) if isinstance(v, (int, float))]
+
+        def avg(rows, name):
+            nums = numbers(rows, name)
+            return sum(nums) / len(nums) if nums else None
+
+        functions = {
+            'count': lambda rows, name: len(rows),
+            'count_distinct': lambda rows, name: len(set(hashable(get_path(r, name)) for r in rows) - {None}),
+            'sum': lambda rows, name: sum(numbers(rows, name)),
+            'min': lambda rows, name: min((v for v in (get_path(r, name) for r in rows) if v is not None), key=sort_key, default=None),
+            'max': lambda rows, name: max((get_path(r, name) for r in rows), key=sort_key, default=None),
+            'avg': avg,
+        }
+        for a in aggregates.values():
+            if not isinstance(a, Aggregate) or a.op not in functions:
+                raise Exception('not an aggregate: ' + str(a))
+        groups = {}
+        for row in self._rows():
+            key = tuple(get_path(row, path) for name, path in self._group_by)
+            groups.setdefault(tuple(hashable(k) for k in key), (key, []))[1].append(row)
+        names = [name for name, path in self._group_by] + list(aggregates.keys())
+        Row = namedtuple(self.entity_type.__name__ + 'Row', names, rename=True)
+        result = []
+        for key, rows in sorted(groups.values(), key=lambda g: sort_key(list(g[0]))):
+            result.append(Row(*key, *(functions[a.op](rows, a.name) for a in aggregates.values())))
+        return result
+
+    def paginate(self, after=None, limit=100):
+        keys = self._page_keys()
+        values = None if after is None else [sort_key(v) for v in decode_page_token(after)]
+        start = time.perf_counter()
+        try:
+            with self._db.lock:
+                rows = self._page_rows(keys, values, limit)
+        finally:
+            self.store._query_done(time.perf_counter() - start)
+        self._sort(rows)
+        return self._page(rows, keys, limit)
+
+    def _page_rows(self, keys, values, limit):
+        # walks the sorted index of the first sort key from the token on, and stops after limit + 1 rows
+        # plus the rows that tie with the last of them on that key
+        def is_after(row):
+            for (path, desc), value in zip(keys, values):
+                v = sort_key(get_path(row, path))
+                if v != value:
+                    return v < value if desc else v > value
+            return False
+
+        collection = self._collection
+        path, desc = keys[0]
+        index = collection.sorted_index(path)
+        if desc:
+            end = len(index.keys) if values is None else bisect.bisect_right(index.values, values[0])
+            positions = range(end - 1, -1, -1)
+        else:
+            positions = range(0 if values is None else bisect.bisect_left(index.values, values[0]), len(index.keys))
+        groups = self._groups()
+        rows = []
+        last = None
+        for i in positions:
+            if last is not None and index.values[i] != last:
+                break
+            doc = collection.documents[index.keys[i]]
+            if groups and not self._matches(doc, groups):
+                continue
+            if values is not None and not is_after(doc):
+                continue
+            rows.append(doc)
+            if len(rows) == limit + 1:
+                last = index.values[i]
+        return rows
@@ -0,0 +1,116 @@
+import warnings
+from collections import namedtuple
+from typing import Dict, List, Optional, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm import Model, Filterable
+    from arorm.databases.abstract import Filter
+
+
+# system attributes always covered by the primary or edge index
+SYSTEM_PATHS = ('_key', '_id', '_from', '_to')
+
+
+class Index:
+    def __init__(self, type: str, fields: List[Union[str, 'Filterable']], unique=False, sparse=False,
+                 expire_after: Optional[int] = None, name: Optional[str] = None):
+        self.type = type
+        self._fields = list(fields)
+        self.unique = unique
+        self.sparse = sparse
+        self.expire_after = expire_after
+        self.name = name
+
+    @property
+    def fields(self) -> List[str]:
+        # fields can be given as descriptors, which only know their path once the model class exists
+        return [f if isinstance(f, str) else f.get_property_path() for f in self._fields]
+
+    def key(self):
+        return self.type, tuple(self.fields), self.unique, self.sparse, self.expire_after
+
+    def matches(self, existing: dict) -> bool:
+        """compares with an index as returned by the server"""
+        type = existing.get('type', None)
+        if type in ('hash', 'skiplist'):
+            type = 'persistent'
+        return (type == self.type
+                and list(existing.get('fields', [])) == self.fields
+                and bool(existing.get('unique', False)) == self.unique
+                and bool(existing.get('sparse', False)) == self.sparse
+                and existing.get('expiry_time', None) == self.expire_after)
+
+    def covers(self, path: str) -> bool:
+        return bool(self.fields) and self.fields[0] == path
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'Index({})'.format(', '.join(str(k) for k in self.key()))
+
+
+def persistent(*fields, unique=False, sparse=False, name=None) -> Index:
+    return Index('persistent', fields, unique=unique, sparse=sparse, name=name)
+
+
+def unique(*fields, sparse=False, name=None) -> Index:
+    return Index('persistent', fields, unique=True, sparse=sparse, name=name)
+
+
+def ttl(field, expire_after: int, name=None) -> Index:
+    return Index('ttl', [field], expire_after=expire_after, name=name)
+
+
+IndexReport = namedtuple('IndexReport', ['created', 'existing', 'undeclared'])
+
+
+def field_indexes(fields: dict, prefix='') -> List[Index]:
+    from arorm import Field, ModelProperty, ReferenceIdList
+    result = []
+    for name, f in fields.items():
+        index = getattr(f, 'index', None) or (getattr(f, 'kwargs', None) or {}).get('index', None)
+        path = prefix + name
+        if isinstance(f, ReferenceIdList) or (isinstance(f, list) and isinstance(f, ModelProperty)):
+            path += '[*]'
+        if index:
+            result.append(Index('persistent', [path], unique=index == 'unique'))
+        if isinstance(f, ModelProperty) and not isinstance(f, Field):
+            model = isinstance(f, list) and (f.kwargs or {}).get('model', None)
+            sub_fields = getattr(model, '_fields', None) if model else f._fields
+            if sub_fields:
+                result += field_indexes(sub_fields, path + '.')
+    return result
+
+
+def collect(model: 'Model') -> List[Index]:
+    """indexes declared with Field(index=True) and __indexes__"""
+    result = []
+    for index in field_indexes(model._fields) + list(getattr(model, '__indexes__', [])):
+        if index not in result:
+            result.append(index)
+    return result
+
+
+def filter_paths(f: 'Filter'):
+    if f.op in ('and_', 'or_'):
+        for c in f.var:
+            yield from filter_paths(c)
+    elif f.op == 'not_':
+        yield from filter_paths(f.var)
+    elif f.op == 'contains_':
+        yield f.name + '[*]'
+    elif f.op == 'has_prop':
+        yield f.name + '.' + f.var[0]
+    elif f.name is not None:
+        yield f.name
+
+
+def warn_unindexed(model: 'Model', f: 'Filter'):
+    for path in filter_paths(f):
+        if path in SYSTEM_PATHS or any(i.covers(path) for i in model._indexes):
+            continue
+        warnings.warn('{} filters on {}, which has no covering index'.format(model.__name__, path), stacklevel=3)
@@ -0,0 +1,156 @@
+import bisect
+import re
+import threading
+from typing import Dict, List
+
+
+class Instrument:
+    """Base class for instrumentation listeners, override the events you need."""
+
+    def query_start(self, aql, bind_vars):
+        pass
+
+    def query_end(self, aql, bind_vars, elapsed, rows):
+        pass
+
+    def commit_phase(self, phase, elapsed):
+        pass
+
+    def statement(self, aql, elapsed, bytes_sent, rows):
+        pass
+
+    def cache_hit(self, collection):
+        pass
+
+    def cache_miss(self, collection):
+        pass
+
+    def subscriber_error(self, subscriber, error):
+        pass
+
+
+# call sites check this list before doing any timing work, so without registered
+# instruments the overhead is a single truthiness test
+instruments: List[Instrument] = []
+
+
+def register(instrument: Instrument):
+    instruments.append(instrument)
+    return instrument
+
+
+def unregister(instrument: Instrument):
+    if instrument in instruments:
+        instruments.remove(instrument)
+
+
+def emit(event, *args):
+    for i in instruments:
+        getattr(i, event)(*args)
+
+
+_string_re = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+_number_re = re.compile(r'\b\d+(\.\d+)?\b')
+_space_re = re.compile(r'\s+')
+
+
+def query_shape(aql: str) -> str:
+    aql = _string_re.sub('?', aql)
+    aql = _number_re.sub('?', aql)
+    return _space_re.sub(' ', aql).strip()
+
+
+class Histogram:
+    # upper bounds in milliseconds, the last bucket takes everything above
+    bounds = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.rows = 0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, elapsed, rows=0):
+        ms = elapsed * 1000
+        self.count += 1
+        self.total += ms
+        self.rows += rows
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+        self.buckets[bisect.bisect_left(self.bounds, ms)] += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, c in enumerate(self.buckets):
+            seen += c
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'rows': self.rows,
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['inf'], self.buckets)),
+        }
+
+
+class LatencyCollector(Instrument):
+    """Collects latency histograms per query shape, commit phase and commit statement."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.queries: Dict[str, Histogram] = {}
+        self.statements: Dict[str, Histogram] = {}
+        self.commit_phases: Dict[str, Histogram] = {}
+        self.bytes_sent = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _add(self, histograms, key, elapsed, rows=0):
+        with self.lock:
+            h = histograms.get(key, None)
+            if h is None:
+                h = histograms[key] = Histogram()
+            h.add(elapsed, rows)
+
+    def query_end(self, aql, bind_vars, elapsed, rows):
+        self._add(self.queries, query_shape(aql), elapsed, rows)
+
+    def commit_phase(self, phase, elapsed):
+        self._add(self.commit_phases, phase, elapsed)
+
+    def statement(self, aql, elapsed, bytes_sent, rows):
+        self.bytes_sent += bytes_sent
+        self._add(self.statements, query_shape(aql), elapsed, rows)
+
+    def cache_hit(self, collection):
+        self.cache_hits += 1
+
+    def cache_miss(self, collection):
+        self.cache_misses += 1
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'queries': {k: v.to_json() for k, v in self.queries.items()},
+                'statements': {k: v.to_json() for k, v in self.statements.items()},
+                'commit_phases': {k: v.to_json() for k, v in self.commit_phases.items()},
+                'bytes_sent': self.bytes_sent,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+            }
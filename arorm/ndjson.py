@@ -0,0 +1,99 @@
+import gzip
+import io
+import json
+import typing
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm import Model, Field
+    from arorm.store import Store
+
+_META_FIELDS = ('_id', '_key', '_rev')
+
+
+def _field_name(f):
+    if isinstance(f, str):
+        return f
+    return f.get_property_path().split('.')[0]
+
+
+def compile_projection(model: typing.Type['Model'], fields=None) -> List[Tuple[str, 'Field']]:
+    names = fields and set(_field_name(f) for f in fields)
+    projection = []
+    for key, field in model._fields.items():
+        if getattr(field, 'hidden', False):
+            continue
+        if names and key not in names and key not in _META_FIELDS:
+            continue
+        projection.append((key, field))
+    return projection
+
+
+def project(projection, raw: dict) -> dict:
+    data = {}
+    for key, field in projection:
+        # stored values are written as they are, only defaults of missing fields need converting
+        value = raw.get(key, None)
+        if value is None:
+            default = getattr(field, 'default', None)
+            value = default() if callable(default) else default
+            if value is not None:
+                value = field.to_db(value)
+        if value is None and key in _META_FIELDS:
+            continue
+        data[key] = value
+    return data
+
+
+def _writer(fileobj, compress):
+    if compress:
+        return gzip.GzipFile(fileobj=fileobj, mode='wb'), True
+    return fileobj, not isinstance(fileobj, io.TextIOBase)
+
+
+def _reader(fileobj, compress):
+    if compress:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    for line in fileobj:
+        yield line.decode('utf-8') if isinstance(line, bytes) else line
+
+
+def export_ndjson(store: 'Store', model: typing.Type['Model'], fileobj, filter=None, fields=None,
+                  batch_size=1000, compress=False) -> int:
+    projection = compile_projection(model, fields)
+    q = store.query(model)
+    if filter is not None:
+        q = q.filter(*(filter if isinstance(filter, (list, tuple)) else [filter]))
+    out, binary = _writer(fileobj, compress)
+    count = 0
+    try:
+        for raw in q.iter_raw(batch_size=batch_size, fields=fields and [k for k, f in projection]):
+            line = json.dumps(project(projection, raw), separators=(',', ':')) + '\n'
+            out.write(line.encode('utf-8') if binary else line)
+            count += 1
+    finally:
+        if compress:
+            out.close()
+    return count
+
+
+def import_ndjson(store: 'Store', model: typing.Type['Model'], fileobj, batch_size=1000, compress=False,
+                  on_duplicate='error') -> int:
+    batch = []
+    count = 0
+    for line in _reader(fileobj, compress):
+        line = line.strip()
+        if not line:
+            continue
+        doc = json.loads(line)
+        doc.pop('_id', None)
+        doc.pop('_rev', None)
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            store.database.bulk_import(model.__collection__, batch, on_duplicate=on_duplicate)
+            count += len(batch)
+            batch = []
+    if batch:
+        store.database.bulk_import(model.__collection__, batch, on_duplicate=on_duplicate)
+        count += len(batch)
+    return count
@@ -0,0 +1,92 @@
+import typing
+from typing import Dict, List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm import Model
+    from arorm.store import Store
+
+
+def _relations(model):
+    from arorm import Collection, Reference, ReferenceList, RemoteReference, RemoteReferenceList
+    kinds = (Collection, Reference, ReferenceList, RemoteReference, RemoteReferenceList)
+    result = {}
+    for klass in reversed(model.__mro__):
+        result.update((name, r) for name, r in vars(klass).items() if isinstance(r, kinds))
+    return result
+
+
+def relation(model: typing.Type['Model'], r):
+    """
+    the relation descriptor for r, given as attribute name, as descriptor, or as what class access returns:
+    the id field for Reference and ReferenceList, the ref field name for RemoteReference and RemoteReferenceList
+    """
+    relations = _relations(model)
+    if any(r is v for v in relations.values()):
+        return r
+    if isinstance(r, str):
+        if r in relations:
+            return relations[r]
+        matches = [v for v in relations.values() if isinstance(getattr(v, 'ref_field', None), str) and v.ref_field == r]
+    else:
+        matches = [v for v in relations.values() if getattr(v, 'ref_field', None) is r]
+    if len(matches) != 1:
+        raise Exception('{} has {} relation for {}'.format(model.__name__, matches and 'more than one' or 'no', r))
+    return matches[0]
+
+
+def _group(rows, path) -> Dict[str, List['Model']]:
+    groups = {}
+    for row in rows:
+        value = row._data.data
+        for p in path.split('.'):
+            value = value.get(p, None) if isinstance(value, dict) else None
+        groups.setdefault(value, []).append(row)
+    return groups
+
+
+def load(store: 'Store', owners: List['Model'], r):
+    """loads relation r of all owners with one query, later attribute access is served from memory"""
+    from arorm import Collection, Filter, Reference, ReferenceList, RemoteReference, RemoteReferenceList
+    if isinstance(r, RemoteReferenceList):
+        owners = [o for o in owners if o.id and r._name not in o._ref_vals]
+        if owners:
+            ids = [o.id for o in owners]
+            groups = _group(store.query(r.model).filter(Filter(r.ref_field, 'in_', (ids, True))).all(), r.ref_field)
+            for o in owners:
+                o._ref_vals[r._name] = groups.get(o.id, [])
+    elif isinstance(r, RemoteReference):
+        owners = [o for o in owners if o.id and r._name not in o._ref_vals]
+        if owners:
+            ids = [r.use_full_id and o.full_id or o.id for o in owners]
+            groups = _group(store.query(r.model).filter(Filter(r.ref_field, 'in_', (ids, True))).all(), r.ref_field)
+            for o, id in zip(owners, ids):
+                o._ref_vals[r._name] = groups.get(id, [None])[0]
+    elif isinstance(r, Collection):
+        owners = [o for o in owners if r._name not in o._collection_loaded]
+        values = [v for v in (getattr(o, r.own_prop) for o in owners) if v is not None]
+        if values:
+            props = [r.ref_prop] if isinstance(r.ref_prop, str) else list(r.ref_prop)
+            f = None
+            for p in props:
+                f = getattr(r.model, p).in_(values) if f is None else f | getattr(r.model, p).in_(values)
+            store.query(r.model).filter(f).all()
+        for o in owners:
+            if getattr(o, r.own_prop) is not None:
+                o.set_loaded(r._name)
+    elif isinstance(r, Reference):
+        ids: Dict[type, List[str]] = {}
+        for o in owners:
+            value = o._data.data.get(r.ref_field._name, None)
+            if value is not None and r._name not in o._ref_vals:
+                ids.setdefault(r.model or r.get_model_from_id(o), []).append(value)
+        for model, model_ids in ids.items():
+            store.get_many(model, list(dict.fromkeys(model_ids)))
+    elif isinstance(r, ReferenceList):
+        member_ids = dict.fromkeys(id for o in owners for id in getattr(o, r._name).stored_ids())
+        if member_ids:
+            store.get_many(r.model, list(member_ids))
+
+
+def prefetch(store: 'Store', entities: List['Model'], relations):
+    for r in relations:
+        load(store, entities, r)
@@ -0,0 +1,116 @@
+from types import MappingProxyType
+from typing import Dict, List, Type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from arorm import Model
+    from arorm.store import Store
+
+
+class Record:
+    """
+    read-only view of a document, returned by queries in readonly() mode.
+    records are not registered in a store and have no dirty tracking, promote() turns one into a tracked model.
+    """
+    __slots__ = ()
+    _model = None
+    _converters = ()
+
+    @classmethod
+    def from_db(cls, data: dict) -> 'Record':
+        record = object.__new__(cls)
+        for name, convert, default in cls._converters:
+            value = data.get(name, None)
+            if value is None and default is not None:
+                value = default() if callable(default) else default
+            if convert is not None:
+                value = convert(value)
+            object.__setattr__(record, name, value)
+        return record
+
+    def __setattr__(self, key, value):
+        raise AttributeError('{} is read only'.format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    @property
+    def id(self):
+        return getattr(self, '_key', None)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __hash__(self):
+        return hash((type(self), getattr(self, '_id', None)))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(f'{n}={getattr(self, n)!r}' for n in self.__slots__))
+
+    def _asdict(self) -> dict:
+        return {n: _plain(getattr(self, n), False) for n in self.__slots__}
+
+    def _to_db(self) -> dict:
+        fields = self._model._fields
+        return {n: _plain(getattr(self, n), True, fields[n]) for n in self.__slots__}
+
+    def promote(self, store: 'Store') -> 'Model':
+        """the tracked model for this document, the one already in the store's identity map if there is one"""
+        return store.add_batch(self._model, [self._to_db()])[0]
+
+
+def _plain(value, to_db, field=None):
+    if isinstance(value, Record):
+        return value._to_db() if to_db else value._asdict()
+    if isinstance(value, MappingProxyType):
+        return {k: _plain(v, to_db) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_plain(v, to_db) for v in value]
+    if to_db and field is not None and value is not None:
+        return field.to_db(value)
+    return value
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+_record_classes: Dict[type, Type[Record]] = {}
+
+
+def _converter(field):
+    from arorm import DictProperty, Field, ListProperty, ObjectProperty
+    if isinstance(field, ListProperty):
+        model = (field.kwargs or {}).get('model', None)
+        if isinstance(model, type) and getattr(model, '_fields', None):
+            record = record_class(model)
+            return lambda v: tuple(record.from_db(x) for x in v or ())
+        return lambda v: _freeze(v or [])
+    if isinstance(field, ObjectProperty):
+        record = record_class(type(field))
+        return lambda v: record.from_db(v or {})
+    if isinstance(field, DictProperty):
+        return lambda v: _freeze(v or {})
+    # list and dict values of any other field, e.g. a ReferenceIdList, are frozen as well
+    if getattr(type(field), 'from_db', Field.from_db) is Field.from_db:
+        return _freeze
+    return lambda v: None if v is None else _freeze(field.from_db(v))
+
+
+def record_class(model) -> Type[Record]:
+    """the slotted record class for a model or object property class, created once"""
+    if model not in _record_classes:
+        converters = tuple((name, _converter(f), getattr(f, 'default', None)) for name, f in model._fields.items())
+        _record_classes[model] = type(model.__name__ + 'Record', (Record,), {
+            '__slots__': tuple(model._fields.keys()),
+            '_model': model,
+            '_converters': converters,
+        })
+    return _record_classes[model]
+
+
+def load(model, rows) -> List[Record]:
+    from_db = record_class(model).from_db
+    return [from_db(row) for row in rows]
@@ -0,0 +1,177 @@
+import copy
+import json
+import typing
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from . import prefetch
+from .ndjson import _META_FIELDS, _field_name, compile_projection
+
+if TYPE_CHECKING:
+    from arorm import Model
+    from arorm.store import Store
+
+
+class Projection:
+    """the fields of a model to serialize, compiled once per model and field list"""
+
+    def __init__(self, model: typing.Type['Model'], fields=None):
+        from arorm import Field, ModelProperty
+        self.model = model
+        self.columns = []
+        for key, field in compile_projection(model, fields):
+            to_db = field.to_db
+            if isinstance(field, ModelProperty) or getattr(type(field), 'to_db', Field.to_db) is Field.to_db:
+                to_db = None
+            self.columns.append((key, to_db, getattr(field, 'default', None), getattr(field, 'ref_name', None)))
+
+    def dump(self, entity: 'Model') -> dict:
+        data = entity._data.data
+        properties = entity._properties
+        ref_vals = entity._ref_vals
+        result = {}
+        for key, to_db, default, ref_name in self.columns:
+            if ref_name and ref_name in ref_vals:
+                # the id comes from a referenced entity that is not in the document yet
+                value = getattr(entity, key)
+            elif key in properties:
+                value = properties[key]._dump()
+            else:
+                value = data.get(key, None)
+                if value is None and default is not None:
+                    value = default() if callable(default) else copy.copy(default)
+            if value is not None and to_db is not None:
+                value = to_db(value)
+            if value is None and key in _META_FIELDS:
+                continue
+            result[key] = value
+        return result
+
+
+_projections: Dict[Tuple[type, Optional[tuple]], Projection] = {}
+
+
+def projection(model: typing.Type['Model'], fields=None) -> Projection:
+    key = (model, fields and tuple(_field_name(f) for f in fields))
+    if key not in _projections:
+        _projections[key] = Projection(model, key[1])
+    return _projections[key]
+
+
+def expand_tree(expand: Iterable[str]) -> dict:
+    """['author', 'author.publisher', 'co_authors'] -> {'author': {'publisher': {}}, 'co_authors': {}}"""
+    tree = {}
+    for path in expand or ():
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+_relations: Dict[Tuple[type, str], object] = {}
+
+
+def _relation(model, name):
+    if (model, name) not in _relations:
+        relation = prefetch._relations(model).get(name, None)
+        if relation is None:
+            raise Exception('{} has no reference named {}'.format(model.__name__, name))
+        _relations[model, name] = relation
+    return _relations[model, name]
+
+
+def _full_id(model, id):
+    return id if '/' in id else model.__collection__ + '/' + id
+
+
+def resolve(store: 'Store', entities: List['Model'], tree: dict, resolved: dict):
+    """
+    loads the expanded relations of all entities, one get_many per referenced model and level,
+    or one query per relation for relations stored on the other side.
+    resolved maps (entity, name) to the referenced entity or list of entities.
+    """
+    from arorm import Reference, ReferenceList
+    for name, sub_tree in tree.items():
+        wanted: Dict[type, Dict[str, None]] = {}
+        pending = []
+        remote: Dict[object, List['Model']] = {}
+        for e in entities:
+            relation = _relation(type(e), name)
+            if not isinstance(relation, (Reference, ReferenceList)):
+                remote.setdefault(relation, []).append(e)
+                continue
+            if isinstance(relation, Reference):
+                if name in e._ref_vals:
+                    resolved[e, name] = e._ref_vals[name]
+                    continue
+                ref = e._data.data.get(relation.ref_field._name, None)
+                if ref is None:
+                    resolved[e, name] = None
+                    continue
+                model = relation.model or relation.get_model_from_id(e)
+                ids = [_full_id(model, ref)]
+                added = None
+            else:
+                members = getattr(e, name)
+                model = relation.model
+                ids = [_full_id(model, id) for id in members.stored_ids()]
+                added = list(members.added)
+            wanted.setdefault(model, {}).update(dict.fromkeys(ids))
+            pending.append((e, ids, added))
+
+        loaded = {}
+        for model, ids in wanted.items():
+            ids = list(ids)
+            loaded.update(zip(ids, store.get_many(model, ids)))
+        for e, ids, added in pending:
+            if added is None:
+                resolved[e, name] = loaded.get(ids[0], None)
+            else:
+                resolved[e, name] = [loaded[id] for id in ids if loaded.get(id, None) is not None] + added
+        # relations stored on the other side are loaded with one query each
+        for relation, owners in remote.items():
+            prefetch.load(store, owners, relation)
+            for o in owners:
+                value = getattr(o, name)
+                resolved[o, name] = list(value) if isinstance(value, list) else value
+
+        if sub_tree:
+            targets = {}
+            for e in entities:
+                value = resolved[e, name]
+                for t in (value if isinstance(value, list) else [value]):
+                    if t is not None:
+                        targets[t] = None
+            resolve(store, list(targets), sub_tree, resolved)
+
+
+def render(entity: 'Model', fields, tree: dict, resolved: dict) -> dict:
+    data = projection(type(entity), fields).dump(entity)
+    for name, sub_tree in tree.items():
+        value = resolved[entity, name]
+        if isinstance(value, list):
+            data[name] = [render(v, None, sub_tree, resolved) for v in value]
+        else:
+            data[name] = render(value, None, sub_tree, resolved) if value is not None else None
+    return data
+
+
+def serialize(store: 'Store', entities: Iterable['Model'], fields=None, expand=None, stream=False):
+    """
+    json ready dicts of the entities, without hidden fields. fields limits the top level fields,
+    expand lists references to embed, nested ones with dots. with stream a generator of json text chunks is returned.
+    """
+    entities = list(entities)
+    tree = expand_tree(expand)
+    resolved = {}
+    if tree:
+        resolve(store, entities, tree, resolved)
+    if not stream:
+        return [render(e, fields, tree, resolved) for e in entities]
+    return _stream(entities, fields, tree, resolved)
+
+
+def _stream(entities, fields, tree, resolved):
+    yield '['
+    for i, e in enumerate(entities):
+        yield (i and ',' or '') + json.dumps(render(e, fields, tree, resolved), separators=(',', ':'))
+    yield ']'
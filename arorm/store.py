@@ -1,17 +1,51 @@
+import itertools
+import json
+from collections import namedtuple
+from itertools import chain
+import threading
+import time
 import typing
+import weakref
 from typing import Set, Dict, List, TYPE_CHECKING, TypeVar
 import event_emitter as events
+import gevent
 import gevent.lock
+import gevent.monkey
+from concurrent.futures import ThreadPoolExecutor
 
+from . import changes as changes_module, instrumentation
+from .changes import ChangeSet
 from .databases import databases
 from .databases.abstract import StoreQuery
 
 if TYPE_CHECKING:
-    from core.orm import Model, ORM
+    from arorm import Model, ORM
 
 T = TypeVar('T')
 
 
+# every live store, for global_stats
+_stores: 'weakref.WeakSet[Store]' = weakref.WeakSet()
+
+
+def global_stats() -> dict:
+    """the stats of all live stores in this process, summed up"""
+    result = dict(stores=0, collections={})
+    for store in list(_stores):
+        stats = store.stats()
+        result['stores'] += 1
+        for name, c in stats.pop('collections').items():
+            totals = result['collections'].setdefault(name, dict(entities=0, estimated_bytes=0))
+            totals['entities'] += c['entities']
+            totals['estimated_bytes'] += c['estimated_bytes']
+        for key, value in stats.items():
+            result[key] = result.get(key, 0) + value
+    return result
+
+
+RefreshResult = namedtuple('RefreshResult', ['updated', 'conflicts', 'missing'])
+
+
 class Store:
     _cache: Dict[str, 'Model']
     _cache_by_type: Dict[str, List['Model']]
@@ -21,13 +55,38 @@ class Store:
     queue_ops: List[typing.Tuple['StoreQuery', str, List['str']]] # query, action, collections
     events: events.EventEmitter
 
-    def __init__(self, config=None):
-        self.lock = gevent.lock.Semaphore()
+    def __init__(self, config=None, auto_flush_count=None, auto_flush_bytes=None, auto_flush_interval=None,
+                 single_round_trip=False, warn_unindexed=False, read_configs=None, read_your_writes_seconds=5):
+        self.lock = gevent.lock.RLock()
+        # the counters are also updated by the threads of gather, which the gevent lock does not cover
+        self._stats_lock = threading.Lock()
         self.clear()
         self.run_after_commit_callbacks = []
+        self.auto_flush_count = auto_flush_count
+        self.auto_flush_bytes = auto_flush_bytes
+        self.auto_flush_interval = auto_flush_interval
+        self.single_round_trip = single_round_trip
+        # development aid: warn when a query filters on a path without a declared index
+        self.warn_unindexed = warn_unindexed
+        # cursor option defaults by collection, None applies to every query
+        self.query_options: Dict[typing.Optional[str], dict] = {}
+        self._flush_error = None
+        self._flush_greenlet = None
+        if auto_flush_interval:
+            self._flush_greenlet = gevent.spawn(Store._auto_flush_loop, weakref.ref(self), auto_flush_interval)
+        # queries go to the read endpoints, except for collections this store has pending
+        # changes for or wrote to in the last read_your_writes_seconds
+        self.read_databases = []
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self._written: Dict[str, float] = {}
+        # (fn, collections or None) pairs, see subscribe
+        self._subscribers: List[typing.Tuple[typing.Callable[[ChangeSet], None], typing.Optional[Set[str]]]] = []
         if config:
             self.database = databases[config.driver].create_database(config)
             self.__query = databases[config.driver].Query
+            self.read_databases = [databases[c.driver].create_database(c) for c in read_configs or []]
+        self._read_databases = itertools.cycle(self.read_databases)
+        _stores.add(self)
 
     def clear(self):
         self._cache = {}
@@ -38,11 +97,83 @@ class Store:
         self.events = events.EventEmitter()
         self.run_after_commit_callbacks = []
         self.queue_ops = []
+        self._pending_bytes = 0
+        # loaded entities that became dirty since the last commit
+        self._dirtied = 0
+        # collections with new, changed or removed entities or queued operations, see read_database
+        self._pending_collections: Set[str] = set()
+        self._committing = False
+        self._last_commit = time.monotonic()
+        self._stats = dict(get_hits=0, get_misses=0, queries=0, query_time=0.0, commits=0, commit_time=0.0)
+
+    @staticmethod
+    def _auto_flush_loop(ref, interval):
+        while True:
+            gevent.sleep(interval)
+            store = ref()
+            if store is None:
+                return
+            store._auto_flush_tick(interval)
+            store = None
+
+    def _auto_flush_tick(self, interval):
+        if time.monotonic() - self._last_commit < interval:
+            return
+        with self.lock:
+            if not (self._new or self._removed or self.queue_ops or self._get_changed()):
+                self._last_commit = time.monotonic()
+                return
+            try:
+                self._commit()
+            except Exception as e:
+                # raised on the next call into the store from the owning code
+                self._flush_error = e
+                self._last_commit = time.monotonic()
+
+    def _raise_flush_error(self):
+        if self._flush_error is not None:
+            e, self._flush_error = self._flush_error, None
+            raise e
+
+    def _maybe_flush(self):
+        self._raise_flush_error()
+        if self._committing:
+            return
+        pending = len(self._new) + len(self._removed) + len(self.queue_ops) + self._dirtied
+        if self.auto_flush_count and pending >= self.auto_flush_count:
+            return self.commit()
+        if self.auto_flush_bytes and self._pending_bytes >= self.auto_flush_bytes:
+            return self.commit()
+
+    def close(self):
+        if self._flush_greenlet is not None:
+            self._flush_greenlet.kill()
+            self._flush_greenlet = None
+        self._raise_flush_error()
+
+    def _entity_dirtied(self, entity: 'Model'):
+        # new entities are already counted in _new
+        if not entity._id:
+            return
+        self._pending_collections.add(entity.__collection__)
+        self._dirtied += 1
+        if self.auto_flush_bytes:
+            self._pending_bytes += len(json.dumps(entity._data.json, default=str))
+
+    def _queue_op(self, query, action, collections):
+        with self.lock:
+            self._maybe_flush()
+            self.queue_ops.append([query, action, collections])
+            self._pending_collections.update(collections)
 
     def fork(self):
-        s = Store()
+        s = Store(single_round_trip=self.single_round_trip, warn_unindexed=self.warn_unindexed,
+                  read_your_writes_seconds=self.read_your_writes_seconds)
         s.database = self.database
         s.__query = self.__query
+        s.query_options = {k: dict(v) for k, v in self.query_options.items()}
+        s.read_databases = self.read_databases
+        s._read_databases = itertools.cycle(s.read_databases)
         return s
 
     def graph(self, name):
@@ -50,8 +181,12 @@ class Store:
 
     def create(self, model: typing.Type[T], data) -> T:
         data = data or {}
-        d = model(data=data, store=self)
-        return self.add(d)
+        with self.lock:
+            self._maybe_flush()
+            if self.auto_flush_bytes:
+                self._pending_bytes += len(json.dumps(data, default=str))
+            d = model(data=data, store=self)
+            return self.add(d)
 
     def get(self, type: T, id) -> T:
         from . import ORM
@@ -59,11 +194,32 @@ class Store:
         if '/' not in id:
             id = type.__collection__ + '/' + id
         value = self._cache.get(id, None)
+        self._count(**{value and 'get_hits' or 'get_misses': 1})
+        if instrumentation.instruments:
+            instrumentation.emit(value and 'cache_hit' or 'cache_miss', type.__collection__)
         if value: return value
         return self.query(type).find_one(id)
 
+    def get_many(self, type: T, ids: List[str]) -> List[T]:
+        """like get for many ids, the ones missing from the cache are loaded with one query"""
+        from . import ORM
+        type = ORM.model(type)
+        ids = [id if '/' in id else type.__collection__ + '/' + id for id in ids]
+        missing = [id for id in ids if not self._cache.get(id, None)]
+        self._count(get_hits=len(ids) - len(missing), get_misses=len(missing))
+        if instrumentation.instruments:
+            for id in ids:
+                instrumentation.emit(id in missing and 'cache_miss' or 'cache_hit', type.__collection__)
+        if missing:
+            self.query(type).find_many([id.split('/')[-1] for id in missing])
+        return [self._cache.get(id, None) for id in ids]
+
     def add(self, entity: 'Model'):
-        from core.orm import ReferenceId, Reference
+        with self.lock:
+            return self._add(entity)
+
+    def _add(self, entity: 'Model'):
+        from arorm import ReferenceId, Reference
         if entity.full_id in self._cache:
             if self._cache[entity.full_id]:
                 if self._cache[entity.full_id].rev != entity.rev:
@@ -74,6 +230,7 @@ class Store:
             self._cache_by_type[entity.__collection__] = []
         if not entity._id:
             self._new.add(entity)
+            self._pending_collections.add(entity.__collection__)
             self._cache_by_type[entity.__collection__].append(entity)
             if entity._key:
                 self._cache[entity.full_id] = entity
@@ -90,22 +247,61 @@ class Store:
                     l = self._cache_by_type_index[idx]
                     l.append(entity)
         else:
-            self._cache[entity.full_id] = entity
-            self._cache_by_type[entity.__collection__].append(entity)
-            for name, f in entity._fields.items():
-                if isinstance(f, ReferenceId):
-                    if not getattr(entity, f._name): continue
-                    if isinstance(f, ReferenceId):
-                        value = getattr(entity, f._name)
-                    idx = entity.__collection__ + '_' + f._name + '_' + value
-                    if idx not in self._cache_by_type_index:
-                        self._cache_by_type_index[idx] = []
-                    l = self._cache_by_type_index[idx]
-                    l.append(entity)
+            self._add_loaded(entity)
         entity._setup_store(self)
         self.events.emit('add', entity)
         return entity
 
+    def _add_loaded(self, entity: 'Model'):
+        self._cache[entity.full_id] = entity
+        self._cache_by_type[entity.__collection__].append(entity)
+        self._index_references(entity)
+
+    def _index_references(self, entity: 'Model'):
+        for name in entity._reference_id_fields:
+            value = getattr(entity, name)
+            if value:
+                self._cache_by_type_index.setdefault(entity.__collection__ + '_' + name + '_' + value, []).append(entity)
+
+    def _unindex_references(self, entity: 'Model'):
+        for name in entity._reference_id_fields:
+            value = getattr(entity, name)
+            index = value and self._cache_by_type_index.get(entity.__collection__ + '_' + name + '_' + value, None)
+            if index and entity in index:
+                index.remove(entity)
+
+    @staticmethod
+    def _from_db(entity_type, data):
+        for key, from_db, default in entity_type._from_db_converters:
+            value = data.get(key, default)
+            data[key] = from_db(value) if from_db else value
+        return data
+
+    def add_batch(self, entity_type: T, rows, copy=None) -> List[T]:
+        """adds raw documents from the database, only documents not in the identity map are turned into entities"""
+        entities = []
+        added = []
+        with self.lock:
+            if entity_type.__collection__ not in self._cache_by_type:
+                self._cache_by_type[entity_type.__collection__] = []
+            for row in rows:
+                cached = self._cache.get(row['_id'], None)
+                if cached:
+                    if cached.rev != row.get('_rev', None):
+                        raise Exception("revision for " + row['_id'] + " changed")
+                    entities.append(cached)
+                    continue
+                entity = entity_type(self._from_db(entity_type, copy(row) if copy else row))
+                self._add_loaded(entity)
+                entity._setup_store(self)
+                entities.append(entity)
+                added.append(entity)
+        for entity in added:
+            self.events.emit('add', entity)
+        if added:
+            self.events.emit('add_batch', added)
+        return entities
+
     def get_all(self, entity_type: 'Model', index=None, index_value=None):
         if index:
             idx = entity_type.__collection__ + '_' + index + '_' + index_value
@@ -114,17 +310,54 @@ class Store:
             return []
         return self._cache_by_type.get(entity_type.__collection__, [])
 
-    def commit(self):
+    def commit(self, single_round_trip=None):
+        with self.lock:
+            self._raise_flush_error()
+            start = time.perf_counter()
+            try:
+                self._commit(single_round_trip)
+            finally:
+                self._count(commits=1, commit_time=time.perf_counter() - start)
+
+    def _commit(self, single_round_trip=None):
+        self._committing = True
+        try:
+            self._commit_pending(single_round_trip)
+        finally:
+            self._committing = False
+
+    def _commit_pending(self, single_round_trip=None):
+        if single_round_trip is None:
+            single_round_trip = self.single_round_trip
         changes = self._get_changed()
-        self.database.commit(self._new, changes, self._removed, self.queue_ops)
+        ops = list(self.queue_ops)
+        if self._subscribers:
+            change_set = changes_module.build(list(self._new), [(e, set(e._dirty)) for e in changes], list(self._removed), ops)
+        if self.read_databases:
+            now = time.monotonic()
+            for e in chain(self._new, changes, self._removed):
+                self._written[e.__collection__] = now
+            for op in ops:
+                for collection in op[2]:
+                    self._written[collection] = now
+        self.database.commit(self._new, changes, self._removed, self.queue_ops, single_round_trip=single_round_trip)
         for e in changes:
-            e._dirty = set()
+            e._dirty.clear()
         for n in self._new:
             self._cache[n.full_id] = n
+        for op in ops:
+            if op[1] == 'update':
+                self._merge_updated(op[0]._updated_rows)
 
         self._new = set()
         self._removed = set()
         self.queue_ops = []
+        self._pending_bytes = 0
+        self._dirtied = 0
+        self._pending_collections = set()
+        self._last_commit = time.monotonic()
+        if self._subscribers:
+            self._publish(change_set)
         for fn in self.run_after_commit_callbacks:
             try:
                 fn()
@@ -132,12 +365,97 @@ class Store:
                 print('run_after_commit_callbacks failed', e)
         self.run_after_commit_callbacks = []
 
+    def subscribe(self, fn: typing.Callable[[ChangeSet], None], models=None):
+        """fn gets a ChangeSet after each commit that changed one of the models, or any collection without models"""
+        from . import ORM
+        collections = models is not None and set(ORM.model(m).__collection__ for m in models) or None
+        self._subscribers.append((fn, collections))
+        return fn
+
+    def unsubscribe(self, fn):
+        self._subscribers = [s for s in self._subscribers if s[0] is not fn]
+
+    def _publish(self, change_set: ChangeSet):
+        for fn, collections in list(self._subscribers):
+            changes = change_set.only(collections)
+            if not changes:
+                continue
+            try:
+                fn(changes)
+            except Exception as e:
+                instrumentation.emit('subscriber_error', fn, e)
+
+    def _merge_updated(self, rows):
+        for row in rows:
+            entity = self._cache.get(row['_id'], None)
+            if entity is None:
+                continue
+            # the merged values can change reference ids, which get_all and Collection look up by
+            self._unindex_references(entity)
+            for key, value in row.items():
+                field = entity._fields.get(key, None)
+                if field is not None and value is not None and key != '_rev':
+                    value = field.from_db(value)
+                entity._data[key] = value
+                entity._properties.pop(key, None)
+                if field is not None and getattr(field, 'ref_name', None):
+                    entity._ref_vals.pop(field.ref_name, None)
+            self._index_references(entity)
+
+    def refresh(self, entities=None) -> RefreshResult:
+        """
+        revalidates cached entities (all of them, the entities of a model or the given list) by their _rev.
+        changed documents are loaded again and merged into clean entities, changed entities
+        with local changes are reported as conflicts and left alone.
+        """
+        from . import ORM
+        with self.lock:
+            if entities is None:
+                entities = [e for e in self._cache.values() if e._id]
+            elif isinstance(entities, (type, str)):
+                entities = [e for e in self._cache_by_type.get(ORM.model(entities).__collection__, []) if e._id]
+            by_type = {}
+            for e in entities:
+                by_type.setdefault(type(e), {})[e._key] = e
+            result = RefreshResult([], [], [])
+            for entity_type, cached in by_type.items():
+                # not self.query, refreshing must not flush the changes it checks for conflicts
+                query = self.__query(self, entity_type)
+                revisions = query.revisions(list(cached.keys()))
+                changed = []
+                for key, e in cached.items():
+                    if key not in revisions:
+                        result.missing.append(e)
+                    elif revisions[key] != e._rev:
+                        if len(e._dirty):
+                            result.conflicts.append(e)
+                        else:
+                            changed.append(key)
+                if not changed:
+                    continue
+                for row in query.fetch_many(changed):
+                    e = cached[row['_key']]
+                    self._unindex_references(e)
+                    e._data.set(self._from_db(entity_type, row))
+                    self._index_references(e)
+                    e._properties.clear()
+                    e._ref_vals.clear()
+                    e._setup_store(self)
+                    result.updated.append(e)
+            return result
+
     def _get_changed(self):
         return [e for e in self._cache.values() if len(e._dirty) and e not in self._new]
 
     def remove(self, entity: 'Model'):
+        with self.lock:
+            self._maybe_flush()
+            self._remove(entity)
+
+    def _remove(self, entity: 'Model'):
         if entity._id and entity not in self._removed:
             self._removed.add(entity)
+            self._pending_collections.add(entity.__collection__)
         if entity.full_id and entity.full_id in self._cache:
             del self._cache[entity.full_id]
             if entity in self._cache_by_type[entity.__collection__]:
@@ -146,18 +464,112 @@ class Store:
             self._new.remove(entity)
         self.events.emit('remove', entity)
 
+    def gather(self, *queries: StoreQuery) -> List[List['Model']]:
+        # only the round trips run concurrently, the results are merged into the
+        # identity map one query after the other under the store lock
+        if gevent.monkey.is_module_patched('socket'):
+            greenlets = [gevent.spawn(q._fetch) for q in queries]
+            gevent.joinall(greenlets, raise_error=True)
+            rows = [g.value for g in greenlets]
+        else:
+            with ThreadPoolExecutor(max_workers=len(queries) or 1) as executor:
+                rows = list(executor.map(lambda q: q._fetch(), queries))
+        with self.lock:
+            return [q._hydrate(r) for q, r in zip(queries, rows)]
+
+    def _query_done(self, elapsed):
+        self._count(queries=1, query_time=elapsed)
+
+    def _count(self, **values):
+        with self._stats_lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def stats(self, sample_size=100) -> dict:
+        """
+        identity map, pending changes and query metrics since the last clear().
+        estimated_bytes extrapolates the serialized size of up to sample_size entities per collection.
+        """
+        with self._stats_lock:
+            counters = dict(self._stats)
+        with self.lock:
+            collections = {}
+            for name, entities in self._cache_by_type.items():
+                sample = entities[:sample_size]
+                size = sum(len(json.dumps(e._data.json, default=str)) for e in sample)
+                collections[name] = dict(
+                    entities=len(entities),
+                    estimated_bytes=sample and size * len(entities) // len(sample) or 0,
+                )
+            return dict(
+                collections=collections,
+                entities=len(self._cache),
+                estimated_bytes=sum(c['estimated_bytes'] for c in collections.values()),
+                reference_indexes=len(self._cache_by_type_index),
+                reference_index_entries=sum(len(v) for v in self._cache_by_type_index.values()),
+                pending_new=len(self._new),
+                pending_changed=len(self._get_changed()),
+                pending_removed=len(self._removed),
+                pending_ops=len(self.queue_ops),
+                **counters,
+            )
+
+    def _pinned(self, collection):
+        if collection in self._pending_collections:
+            return True
+        written = self._written.get(collection, None)
+        return written is not None and time.monotonic() - written < self.read_your_writes_seconds
+
+    def read_database(self, collections=None):
+        """
+        the database to read the collections from, the write database if they are pinned.
+        without collections a read endpoint is only used when nothing is pinned.
+        """
+        if not self.read_databases:
+            return self.database
+        if collections is None:
+            collections = chain(self._pending_collections, self._written)
+        if any(self._pinned(c) for c in collections):
+            return self.database
+        return next(self._read_databases)
+
     def query(self, entity_type: T) -> StoreQuery[T]:
+        # load-modify loops only call into the store to query, so the flush thresholds are checked here too
+        if self.auto_flush_count or self.auto_flush_bytes:
+            with self.lock:
+                self._maybe_flush()
         return self.__query(self, entity_type)
 
-    def raw_query(self, q):
-        return self.__query.raw(self.database, q)
+    def set_query_options(self, model=None, **options):
+        """defaults for StoreQuery.options, for the queries of model or for all queries and raw queries"""
+        from . import ORM
+        from .databases.abstract import check_options
+        collection = model and ORM.model(model).__collection__
+        self.query_options.setdefault(collection, {}).update(check_options(options))
+
+    def raw_query(self, q, collections=None):
+        """collections lists the collections q reads, so it can go to a read endpoint"""
+        return self.__query.raw(self.read_database(collections), q).options(**self.query_options.get(None, {}))
 
     def queue_raw_query(self, q, collections):
-        self.queue_ops.append([self.raw_query(q), 'execute', collections])
+        # queued queries run in the commit, so they always use the write database
+        self._queue_op(self.__query.raw(self.database, q), 'execute', collections)
+
+    def export(self, model: typing.Type['Model'], fileobj, filter=None, fields=None, batch_size=1000, compress=False):
+        from .ndjson import export_ndjson
+        return export_ndjson(self, model, fileobj, filter=filter, fields=fields, batch_size=batch_size, compress=compress)
+
+    def import_(self, model: typing.Type['Model'], fileobj, batch_size=1000, compress=False, on_duplicate='error'):
+        from .ndjson import import_ndjson
+        return import_ndjson(self, model, fileobj, batch_size=batch_size, compress=compress, on_duplicate=on_duplicate)
+
+    def serialize(self, entities: typing.Iterable['Model'], fields=None, expand=None, stream=False):
+        from .serialize import serialize
+        return serialize(self, entities, fields=fields, expand=expand, stream=stream)
 
     def setup_db(self, graphs=[]):
-        from core.orm import ORM
-        self.database.setup_db([m for m in ORM.all_models.values() if not m._embedded], graphs)
+        from arorm import ORM
+        return self.database.setup_db([m for m in ORM.all_models.values() if not m._embedded], graphs)
 
     def run_after_commit(self, fn):
         self.run_after_commit_callbacks.append(fn)
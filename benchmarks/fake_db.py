@@ -0,0 +1,46 @@
+import itertools
+from types import SimpleNamespace
+
+from arorm.databases import register
+from arorm.databases.abstract import AbstractDatabase, DatabaseFactory, StoreQuery
+
+
+class FakeDatabase(AbstractDatabase):
+    def __init__(self):
+        self.collections = {}
+        self._ids = itertools.count(1)
+
+    def commit(self, new, changes, removed, query_ops, single_round_trip=False):
+        collected = set()
+        for e in (e for batch in self._compute_batch_order(new, collected) for e in batch):
+            key = e._key or str(next(self._ids))
+            e._data['_key'] = key
+            e._data['_id'] = e.__collection__ + '/' + key
+            e._data['_rev'] = '1'
+            self.collections.setdefault(e.__collection__, {})[key] = e._dump()
+        for e in changes:
+            self.collections.setdefault(e.__collection__, {})[e._key] = e._dump(changes_only=True)
+        for e in removed:
+            self.collections.get(e.__collection__, {}).pop(e._key, None)
+
+
+class FakeQuery(StoreQuery):
+    def __init__(self, store, entity_type):
+        self.store = store
+        self.entity_type = entity_type
+
+
+class FakeDatabaseFactory(DatabaseFactory):
+    Query = FakeQuery
+
+    @staticmethod
+    def create_database(settings):
+        return FakeDatabase()
+
+
+register('fake', FakeDatabaseFactory)
+
+
+def create_store():
+    from arorm.store import Store
+    return Store(SimpleNamespace(driver='fake'))
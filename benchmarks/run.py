@@ -0,0 +1,346 @@
+"""Benchmarks for the python side of arorm, run against a fake database without a server.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+"""
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import typing
+
+from arorm import Model, Field, ListProperty, ObjectProperty, ReferenceId, Reference, ReferenceIdList, ReferenceList
+from benchmarks.fake_db import create_store
+
+
+class BenchAttributes(ObjectProperty):
+    last_login: float = Field(default=0)
+    score: float = Field(default=0)
+
+
+class BenchUser(Model):
+    __collection__ = 'bench_users'
+    name = Field()
+    email = Field()
+    attributes = BenchAttributes()
+    tags: typing.List[str] = ListProperty(str)
+
+
+class BenchBook(Model):
+    __collection__ = 'bench_books'
+    title = Field()
+    pages = Field()
+    author_id = ReferenceId()
+    author = Reference(author_id, BenchUser)
+    co_authors_ids = ReferenceIdList()
+    co_authors: typing.List[BenchUser] = ReferenceList(co_authors_ids, BenchUser)
+
+
+class BenchNode(Model):
+    __collection__ = 'bench_nodes'
+    previous_id = ReferenceId()
+    previous = Reference(previous_id, 'BenchNode')
+
+
+def user_doc(i):
+    return {
+        '_id': 'bench_users/' + str(i),
+        '_key': str(i),
+        '_rev': '_rev' + str(i),
+        'name': 'user ' + str(i),
+        'email': 'user%d@example.com' % i,
+        'attributes': {'last_login': float(i), 'score': i % 100},
+        'tags': ['a', 'b', 'c'],
+    }
+
+
+def book_doc(i):
+    return {
+        '_id': 'bench_books/' + str(i),
+        '_key': str(i),
+        '_rev': '_rev' + str(i),
+        'title': 'book ' + str(i),
+        'pages': i % 1000,
+        'author_id': str(i % 100),
+        'co_authors_ids': [str(i % 7), str(i % 11)],
+    }
+
+
+def measure(fn, setup=None, repeat=3):
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        gc.collect()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def result(n, seconds, **extra):
+    return dict(n=n, seconds=seconds, per_op_us=seconds / n * 1e6 if n else None, **extra)
+
+
+def bench_from_db(n):
+    docs = [user_doc(i) for i in range(n)]
+
+    def run():
+        for d in docs:
+            BenchUser(dict(d), from_db=True)
+    return result(n, measure(run))
+
+
+def bench_store_add(n):
+    def setup():
+        return create_store(), [BenchBook(book_doc(i), from_db=True) for i in range(n)]
+
+    def run(store, books):
+        for b in books:
+            store.add(b)
+    return result(n, measure(run, setup, repeat=1 if n >= 1000000 else 3))
+
+
+def bench_hydrate(n, cached):
+    def setup():
+        store = create_store()
+        if cached:
+            store.add_batch(BenchBook, [book_doc(i) for i in range(n)])
+        return store, [book_doc(i) for i in range(n)]
+
+    def run(store, rows):
+        store.add_batch(BenchBook, rows)
+    return result(n, measure(run, setup))
+
+
+def bench_hydrate_readonly(n):
+    from arorm import records
+
+    def setup():
+        return [book_doc(i) for i in range(n)],
+
+    def run(rows):
+        records.load(BenchBook, rows)
+    return result(n, measure(run, setup))
+
+
+def bench_serialize(n, expand):
+    def setup():
+        store = create_store()
+        store.add_batch(BenchUser, [user_doc(i) for i in range(100)])
+        return store, store.add_batch(BenchBook, [book_doc(i) for i in range(n)])
+
+    def run(store, books):
+        store.serialize(books, expand=expand)
+    return result(n, measure(run, setup))
+
+
+def bench_to_columns(n):
+    from types import SimpleNamespace
+    from arorm import columns
+    rows = [[d['name'], d['attributes']['last_login'], d['attributes']['score']] for d in map(user_doc, range(n))]
+    query = SimpleNamespace(entity_type=BenchUser, _column_rows=lambda paths, batch_size: iter(rows))
+
+    def run():
+        columns.collect(query, [BenchUser.name, BenchUser.attributes.last_login, BenchUser.attributes.score], {},
+                        typecodes={'attributes_score': 'd'})
+    return result(n, measure(run))
+
+
+def bench_dump(n, changes_only):
+    def setup():
+        store = create_store()
+        users = [store.add(BenchUser(user_doc(i), from_db=True)) for i in range(n)]
+        for u in users:
+            u.name = 'changed'
+        return users,
+
+    def run(users):
+        for u in users:
+            u._dump(changes_only=changes_only)
+    return result(n, measure(run, setup))
+
+
+def bench_batch_order_wide(n):
+    def setup():
+        store = create_store()
+        author = store.create(BenchUser, {'name': 'author'})
+        books = [store.create(BenchBook, {'title': str(i)}) for i in range(n)]
+        for b in books:
+            b.author = author
+        return store, list(store._new)
+
+    def run(store, new):
+        store.database._compute_batch_order(new, set())
+    return result(n, measure(run, setup))
+
+
+def bench_batch_order_deep(n):
+    def setup():
+        store = create_store()
+        prev = None
+        for i in range(n):
+            node = store.create(BenchNode, {})
+            if prev is not None:
+                node.previous = prev
+            prev = node
+        return store, list(store._new)
+
+    def run(store, new):
+        store.database._compute_batch_order(new, set())
+    return result(n, measure(run, setup))
+
+
+def bench_filter_aql(n):
+    from arorm.databases.arango.query import ArangoStoreQuery
+    store = create_store()
+
+    def run():
+        for i in range(n):
+            q = ArangoStoreQuery(store, BenchBook)
+            q.filter(BenchBook.pages >= i, BenchBook.title == 'x', BenchBook.author_id.in_(['1', '2']))
+            q.sort(BenchBook.pages)
+            q._make_aql()
+    return result(n, measure(run))
+
+
+def bench_import_time(n):
+    # a fresh interpreter per run, the import is only cold once per process
+    code = 'import time; t = time.perf_counter(); import arorm, arorm.store; print(time.perf_counter() - t)'
+    times = [float(subprocess.check_output([sys.executable, '-c', code]).decode()) for _ in range(n)]
+    return dict(n=n, seconds=min(times))
+
+
+def bench_property_path(n):
+    def run():
+        for i in range(n):
+            BenchUser.attributes.score == i
+    return result(n, measure(run))
+
+
+def bench_model_from_id(n):
+    from arorm import Reference
+    ref = Reference(BenchBook.author_id, 'any')
+    ref.ref_field = BenchBook._fields['author_id']
+    book = BenchBook({'author_id': 'bench_users/1'}, from_db=True)
+
+    def run():
+        for i in range(n):
+            ref.get_model_from_id(book)
+    return result(n, measure(run))
+
+
+def bench_list_property(n):
+    def setup():
+        store = create_store()
+        doc = user_doc(1)
+        doc['tags'] = [str(i) for i in range(n)]
+        return store, doc
+
+    def run(store, doc):
+        user = store.add(BenchUser(doc, from_db=True))
+        tags = user.tags
+        for i in range(100):
+            tags.append('new' + str(i))
+        user._dump(changes_only=True)
+    return result(n, measure(run, setup))
+
+
+def bench_entity_memory(n):
+    store = create_store()
+    docs = [user_doc(i) for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for d in docs:
+        store.add(BenchUser(d, from_db=True))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return dict(n=n, bytes=after - before, bytes_per_entity=(after - before) / n)
+
+
+def bench_record_memory(n):
+    from arorm import records
+    docs = [user_doc(i) for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = records.load(BenchUser, docs)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return dict(n=n, bytes=after - before, bytes_per_entity=(after - before) / n)
+
+
+def benchmarks(full=False):
+    sizes = [10000, 100000] + (full and [1000000] or [])
+    yield 'import_time', lambda: bench_import_time(5)
+    yield 'property_path', lambda: bench_property_path(100000)
+    yield 'model_from_id', lambda: bench_model_from_id(100000)
+    yield 'model_from_db', lambda: bench_from_db(100000)
+    for n in sizes:
+        yield f'store_add_{n}', lambda n=n: bench_store_add(n)
+    yield 'hydrate_new', lambda: bench_hydrate(100000, False)
+    yield 'hydrate_cached', lambda: bench_hydrate(100000, True)
+    yield 'hydrate_readonly', lambda: bench_hydrate_readonly(100000)
+    yield 'dump', lambda: bench_dump(50000, False)
+    yield 'dump_changes_only', lambda: bench_dump(50000, True)
+    yield 'serialize', lambda: bench_serialize(1000, None)
+    yield 'serialize_expand', lambda: bench_serialize(1000, ['author', 'co_authors'])
+    yield 'to_columns', lambda: bench_to_columns(100000)
+    yield 'batch_order_wide', lambda: bench_batch_order_wide(10000)
+    yield 'batch_order_deep', lambda: bench_batch_order_deep(500)
+    yield 'filter_aql', lambda: bench_filter_aql(20000)
+    yield 'list_property_100k', lambda: bench_list_property(100000)
+    yield 'entity_memory', lambda: bench_entity_memory(20000)
+    yield 'record_memory', lambda: bench_record_memory(20000)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(old, new):
+    for name, r in new['results'].items():
+        o = old['results'].get(name)
+        if not o:
+            continue
+        key = 'seconds' if 'seconds' in r else 'bytes'
+        if o.get(key):
+            print(f'{name:28} {o[key]:12.6f} -> {r[key]:12.6f}  x{r[key] / o[key]:.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='write the json results to this file')
+    parser.add_argument('--compare', help='compare against a previous json result file')
+    parser.add_argument('--only', action='append', help='only run benchmarks starting with this name')
+    parser.add_argument('--full', action='store_true', help='include the 1M entity runs')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, fn in benchmarks(args.full):
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        results[name] = fn()
+        print(name, json.dumps(results[name]), file=sys.stderr)
+
+    output = dict(commit=git_commit(), python=platform.python_version(), time=time.time(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
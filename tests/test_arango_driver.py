@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from arorm import Model, Field, Number
+from arorm.databases.arango import ArangoDatabase
+from arorm.databases.arango.query import ArangoStoreQuery
+from arorm.store import Store
+
+
+class ArBook(Model):
+    __collection__ = 'ar_books'
+    title = Field()
+    year = Number()
+    pages = Number()
+
+
+def query():
+    store = SimpleNamespace(query_options={}, warn_unindexed=False, database=None)
+    return ArangoStoreQuery(store, ArBook)
+
+
+def test_combined_filters_compile_to_aql():
+    q = query().filter(((ArBook.year >= 1990) & (ArBook.year < 2000)) | ~(ArBook.title == 'x'), ArBook.pages > 10)
+    assert q._make_aql() == (
+        'FOR rec IN @@collection\n'
+        'FILTER ((rec.year >= @f0 AND rec.year < @f1) OR NOT (rec.title == @f2)) AND rec.pages > @f3 '
+    )
+    assert q._bind_vars == {'@collection': 'ar_books', 'f0': 1990, 'f1': 2000, 'f2': 'x', 'f3': 10}
+
+
+def test_ranges_are_merged():
+    q = query().filter((ArBook.year >= 1990) & (ArBook.pages > 3) & (ArBook.year > 1980) & (ArBook.year < 2000))
+    assert q._make_aql() == 'FOR rec IN @@collection\nFILTER (rec.year >= @f0 AND rec.year < @f1 AND rec.pages > @f2) '
+    assert q._bind_vars == {'@collection': 'ar_books', 'f0': 1990, 'f1': 2000, 'f2': 3}
+
+
+def arango_store():
+    # entities live in a memory store, commits go to an arango database whose server calls are mocked
+    store = Store(SimpleNamespace(driver='memory'))
+    store.database = ArangoDatabase.__new__(ArangoDatabase)
+    return store
+
+
+def loaded_book(store):
+    book = store.add_batch(ArBook, [{'_id': 'ar_books/1', '_key': '1', '_rev': 'r1', 'title': 'a'}])[0]
+    book.title = 'b'
+    return book
+
+
+def test_failed_single_round_trip_restores_entity_meta():
+    store = arango_store()
+    new = store.create(ArBook, {'title': 'new'})
+    changed = loaded_book(store)
+    with mock.patch.object(ArangoDatabase, 'execute_transaction', side_effect=Exception('failed'), create=True):
+        with pytest.raises(Exception):
+            store.commit(single_round_trip=True)
+
+    assert new._id is None and new._key is None
+    assert new in store._new
+    assert changed._rev == 'r1' and 'title' in changed._dirty
+
+    store.remove(new)
+    assert not store._removed
+
+
+def test_failed_transaction_restores_entity_meta():
+    store = arango_store()
+    new = store.create(ArBook, {'title': 'new'})
+    changed = loaded_book(store)
+    tx = mock.Mock()
+    inserted = [{'_id': 'ar_books/2', '_key': '2', '_rev': 'r2'}]
+    with mock.patch.object(ArangoDatabase, 'begin_transaction', return_value=tx, create=True), \
+            mock.patch.object(ArangoDatabase, '_execute', side_effect=[inserted, Exception('failed')]):
+        with pytest.raises(Exception):
+            store.commit()
+
+    assert tx.abort_transaction.called
+    assert new._id is None and new._key is None and new._rev is None
+    assert changed._rev == 'r1' and 'title' in changed._dirty
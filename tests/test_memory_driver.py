@@ -0,0 +1,70 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from arorm import Model, Field, Number
+from arorm.store import Store
+
+
+class MemBook(Model):
+    __collection__ = 'mem_books'
+    title = Field()
+    year = Number()
+
+
+def create_store(db_name=None):
+    return Store(SimpleNamespace(driver='memory', db_name=db_name))
+
+
+def test_queued_delete_runs_before_inserts():
+    store = create_store()
+    store.create(MemBook, {'title': 'old', 'year': 1})
+    store.commit()
+
+    store.query(MemBook).filter(MemBook.year == 1).delete()
+    book = store.create(MemBook, {'title': 'new', 'year': 1})
+    store.commit()
+
+    assert list(store.database.collection('mem_books').documents) == [book._key]
+
+
+def test_queued_update_runs_after_changes():
+    store = create_store()
+    book = store.create(MemBook, {'title': 'a', 'year': 1})
+    store.commit()
+
+    store.query(MemBook).filter(MemBook.year == 2).update(title='updated')
+    book.year = 2
+    store.commit()
+
+    assert store.database.collection('mem_books').documents[book._key]['title'] == 'updated'
+    assert book.title == 'updated'
+
+
+def test_failed_commit_restores_entity_meta():
+    db_name = 'test_' + uuid.uuid4().hex
+    store = create_store(db_name)
+    changed = store.create(MemBook, {'title': 'a', 'year': 1})
+    store.commit()
+    rev = changed._rev
+
+    # the document of the changed entity is removed behind the store's back, so its update fails
+    # after the new entity has been inserted
+    other = create_store(db_name)
+    other.remove(other.get(MemBook, changed._key))
+    other.commit()
+
+    changed.title = 'b'
+    new = store.create(MemBook, {'title': 'c', 'year': 2})
+    with pytest.raises(Exception):
+        store.commit()
+
+    assert new._id is None and new._key is None and new._rev is None
+    assert new in store._new
+    assert changed._rev == rev
+    assert 'title' in changed._dirty
+    assert list(store.database.collection('mem_books').documents) == []
+
+    store.remove(new)
+    assert not store._removed